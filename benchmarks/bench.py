@@ -0,0 +1,414 @@
+"""
+Benchmark harness for kastle-foundry.
+
+Generates synthetic inputs at a controlled scale, runs the Foundry end to end
+on each of them with --metrics-out, and records rows/s, triples/s, per-stage
+timings, peak memory and output file count as JSON. Results can be saved as a
+baseline and later runs compared against it.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+
+import yaml
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FOUNDRY = os.path.join(REPO_DIR, "kastle-foundry.py")
+EARTHQUAKE_MAPPING = os.path.join(REPO_DIR, "example_inputs", "earthquake-mapping.yaml")
+EARTHQUAKE_DATA = os.path.join(REPO_DIR, "example_inputs", "earthquake_example_data.csv")
+
+WORKLOADS = ("earthquake", "synthetic-csv", "synthetic-xml")
+SCALES = {
+    "small": [1_000, 10_000],
+    "medium": [1_000, 10_000, 100_000, 1_000_000],
+    "full": [1_000, 10_000, 100_000, 1_000_000, 10_000_000],
+}
+DATATYPES = ("xsd:string", "xsd:integer", "xsd:double", "xsd:dateTime", "xsd:boolean", "xsd:date", "rdfs:Literal")
+WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet")
+EPOCH = datetime(2000, 1, 1)
+# Arguments that do not change what is measured, left out of the recorded settings
+UNRECORDED = ("out", "baseline", "work_dir", "threshold")
+
+parser = argparse.ArgumentParser(
+    description="Benchmark kastle-foundry on generated inputs."
+)
+parser.add_argument(
+    "--workloads",
+    default=",".join(WORKLOADS),
+    help=f"Comma-separated workloads to run, from {', '.join(WORKLOADS)} (default: all)"
+)
+parser.add_argument(
+    "--scale",
+    choices=sorted(SCALES),
+    default="small",
+    help="Row counts to run: small (1k, 10k), medium (up to 1M) or full (up to 10M). Default small"
+)
+parser.add_argument(
+    "--rows",
+    type=int,
+    nargs="+",
+    help="Explicit row counts to run; overrides --scale"
+)
+parser.add_argument(
+    "--depth",
+    type=int,
+    default=2,
+    help="Synthetic mappings: levels of instance nodes below the root, default 2"
+)
+parser.add_argument(
+    "--fanout",
+    type=int,
+    default=3,
+    help="Synthetic mappings: connections per instance node, default 3"
+)
+parser.add_argument(
+    "--varids",
+    type=int,
+    default=1,
+    help="Synthetic mappings: number of varid columns joined into each instance URI, default 1"
+)
+parser.add_argument(
+    "--datatypes",
+    default=",".join(DATATYPES),
+    help="Synthetic mappings: comma-separated datatypes cycled over the literal nodes"
+)
+parser.add_argument(
+    "--empty-rate",
+    type=float,
+    default=0.0,
+    help="Synthetic inputs: fraction of literal values left empty, default 0"
+)
+parser.add_argument(
+    "--format",
+    default="nt",
+    help="Foundry --format for every run, default nt"
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Foundry --workers for every run, default 1"
+)
+parser.add_argument(
+    "--foundry-args",
+    default="",
+    help="Extra arguments passed to every Foundry run, e.g. \"--dedup --layout shard --shard-triples 1000000\""
+)
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=3,
+    help="Runs per case; the median run is reported. Default 3"
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+    help="Seed for the input generators, default 0"
+)
+parser.add_argument(
+    "--work-dir",
+    default=os.path.join(tempfile.gettempdir(), "kastle-foundry-bench"),
+    help="Directory for generated inputs (cached between runs) and outputs"
+)
+parser.add_argument(
+    "-o", "--out",
+    default="bench-results.json",
+    help="Path of the results JSON, default bench-results.json"
+)
+parser.add_argument(
+    "--baseline",
+    help="Results JSON to compare against; slower cases are reported and the exit code is 1"
+)
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.10,
+    help="Relative slowdown (or memory growth) that counts as a regression, default 0.10"
+)
+
+
+# ----------------------------------------------------------------
+# Input generators
+# ----------------------------------------------------------------
+
+def synthetic_mapping(depth, fanout, varids, datatypes, record_path=None):
+    """
+    Build a mapping tree: the root and every instance node down to `depth`
+    have `fanout` connections; the nodes below the last level are literals.
+    Returns (mapping, input field names, datatype of each literal column).
+    """
+    varid_columns = [f"k{i}" for i in range(varids)]
+    columns = []
+
+    def node(level, label):
+        if level > depth:
+            name = f"c{len(columns)}"
+            datatype = datatypes[len(columns) % len(datatypes)]
+            columns.append((name, datatype))
+            return {"datatype": datatype, "val_source": name}
+        connections = []
+        for i in range(fanout):
+            connection = {"p": f"ex-ont:p{level}_{i}", "o": node(level + 1, f"{label}_{i}")}
+            if i == 0 and level < depth:
+                connection["inv"] = f"ex-ont:inv{level}"
+            connections.append(connection)
+        return {
+            "type": f"ex-ont:Level{level}",
+            "uri": f"ex-r:n{label}",
+            "varids": list(varid_columns),
+            "connections": connections,
+        }
+
+    mapping = {"metadata": {"name": "Synthetic Mapping"}, "root": node(0, "0")}
+    if record_path:
+        mapping["record_path"] = record_path
+    return mapping, varid_columns + [name for name, _ in columns], dict(columns)
+
+
+def synthetic_value(rng, datatype, n):
+    if datatype == "xsd:integer":
+        return str(rng.randint(-10**6, 10**6))
+    if datatype == "xsd:double":
+        return f"{rng.uniform(-1000, 1000):.6f}"
+    if datatype == "xsd:dateTime":
+        return (EPOCH + timedelta(seconds=rng.randint(0, 10**9))).isoformat() + "Z"
+    if datatype == "xsd:date":
+        return (EPOCH + timedelta(days=rng.randint(0, 10**4))).date().isoformat()
+    if datatype == "xsd:boolean":
+        return rng.choice(("true", "false"))
+    return f"{rng.choice(WORDS)} {rng.choice(WORDS)} {n}"
+
+
+def synthetic_rows(rng, rows, fields, datatypes, empty_rate):
+    for n in range(rows):
+        row = []
+        for field in fields:
+            if field.startswith("k"):
+                # The first varid keeps every row's subjects distinct
+                row.append(str(n) if field == "k0" else rng.choice(WORDS))
+            elif empty_rate and rng.random() < empty_rate:
+                row.append("")
+            else:
+                row.append(synthetic_value(rng, datatypes[field], n))
+        yield row
+
+
+def generate_synthetic(case_dir, rows, settings, xml):
+    rng = random.Random(settings.seed)
+    datatypes = settings.datatypes.split(",")
+    mapping, fields, column_types = synthetic_mapping(
+        settings.depth, settings.fanout, settings.varids, datatypes,
+        record_path="Record" if xml else None)
+    mapping_path = os.path.join(case_dir, "mapping.yaml")
+    with open(mapping_path, "w") as stream:
+        yaml.safe_dump(mapping, stream, sort_keys=False)
+    data_rows = synthetic_rows(rng, rows, fields, column_types, settings.empty_rate)
+    if xml:
+        with open(os.path.join(case_dir, "data", "records.xml"), "w", encoding="utf-8") as stream:
+            stream.write("<Records>\n")
+            for row in data_rows:
+                stream.write("<Record>")
+                stream.write("".join(f"<{f}>{escape(v)}</{f}>" for f, v in zip(fields, row) if v))
+                stream.write("</Record>\n")
+            stream.write("</Records>\n")
+    else:
+        with open(os.path.join(case_dir, "data", "records.csv"), "w", newline="", encoding="utf-8") as stream:
+            writer = csv.writer(stream)
+            writer.writerow(fields)
+            writer.writerows(data_rows)
+    return mapping_path, ["--namespace", "http://example.org/", "--prefix", "ex"]
+
+
+def generate_earthquake(case_dir, rows, settings):
+    """Resample the example earthquake data, giving every row a unique id."""
+    with open(EARTHQUAKE_DATA, newline="", encoding="utf-8") as stream:
+        reader = csv.DictReader(stream)
+        fields = reader.fieldnames
+        sample = list(reader)
+    rng = random.Random(settings.seed)
+    with open(os.path.join(case_dir, "data", "earthquakes.csv"), "w", newline="", encoding="utf-8") as stream:
+        writer = csv.DictWriter(stream, fieldnames=fields)
+        writer.writeheader()
+        for n in range(rows):
+            row = dict(rng.choice(sample))
+            row["id"] = f"{row['id']}-{n}"
+            writer.writerow(row)
+    return EARTHQUAKE_MAPPING, ["--namespace", "http://stko-kwg.geog.ucsb.edu/", "--prefix", "kwg"]
+
+
+def prepare_case(workload, rows, settings):
+    """
+    Generate (or reuse) the inputs of one case. Inputs are cached in the work
+    directory under a key of everything that affects their content.
+    """
+    key = {"workload": workload, "rows": rows, "seed": settings.seed}
+    if workload != "earthquake":
+        key.update(depth=settings.depth, fanout=settings.fanout, varids=settings.varids,
+                   datatypes=settings.datatypes, empty_rate=settings.empty_rate)
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:12]
+    case_dir = os.path.join(settings.work_dir, "inputs", f"{workload}-{rows}-{digest}")
+    ready = os.path.join(case_dir, "case.json")
+    if os.path.exists(ready):
+        with open(ready) as stream:
+            return json.load(stream)
+
+    shutil.rmtree(case_dir, ignore_errors=True)
+    os.makedirs(os.path.join(case_dir, "data"))
+    print(f"Generating {workload} with {rows} rows...", file=sys.stderr)
+    if workload == "earthquake":
+        mapping_path, args = generate_earthquake(case_dir, rows, settings)
+    else:
+        mapping_path, args = generate_synthetic(case_dir, rows, settings, xml=workload == "synthetic-xml")
+    case = {"key": key, "mapping": mapping_path, "data": os.path.join(case_dir, "data"), "args": args}
+    with open(ready, "w") as stream:
+        json.dump(case, stream, indent=1)
+    return case
+
+
+# ----------------------------------------------------------------
+# Running
+# ----------------------------------------------------------------
+
+def count_files(directory):
+    return sum(
+        len([name for name in names if name != "foundry-manifest.json"])
+        for _, _, names in os.walk(directory)
+    )
+
+
+def run_case(case, settings):
+    """Run the Foundry once on a prepared case and return its measurements."""
+    out_dir = os.path.join(settings.work_dir, "output")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    metrics_path = os.path.join(settings.work_dir, "metrics.json")
+    command = [
+        sys.executable, FOUNDRY,
+        "-m", case["mapping"], "-d", case["data"], "-o", out_dir,
+        "--format", settings.format, "--workers", str(settings.workers),
+        "--no-resume", "--metrics-out", metrics_path,
+        "--log-file", os.path.join(settings.work_dir, "foundry.log"),
+        *case["args"], *settings.foundry_args.split(),
+    ]
+    started = time.perf_counter()
+    subprocess.run(command, check=True)
+    wall = time.perf_counter() - started
+    with open(metrics_path) as stream:
+        metrics = json.load(stream)
+    rss = metrics["peak_rss_bytes"] or {}
+    return {
+        # End to end, including interpreter start-up, imports and mapping compilation
+        "wall_s": wall,
+        "rows": metrics["rows"],
+        "triples": metrics["triples"],
+        "rows_per_s": metrics["rows"] / wall,
+        "triples_per_s": metrics["triples"] / wall,
+        "peak_rss_bytes": max(rss.values(), default=None),
+        "files": count_files(out_dir),
+        "stages": metrics["stages"],
+    }
+
+
+def run_benchmarks(settings):
+    rows_list = settings.rows or SCALES[settings.scale]
+    results = []
+    for workload in settings.workloads.split(","):
+        if workload not in WORKLOADS:
+            raise Exception(f"Unknown workload: {workload}")
+        for rows in rows_list:
+            case = prepare_case(workload, rows, settings)
+            runs = [run_case(case, settings) for _ in range(settings.repeat)]
+            median = sorted(runs, key=lambda r: r["wall_s"])[len(runs) // 2]
+            result = {"workload": workload, "rows": rows, **median,
+                      "wall_s_runs": [r["wall_s"] for r in runs],
+                      "wall_s_stdev": statistics.stdev([r["wall_s"] for r in runs]) if len(runs) > 1 else 0.0}
+            results.append(result)
+            print(f"{workload:<14}{rows:>10} rows  {result['rows_per_s']:>10.0f} rows/s  "
+                  f"{result['triples_per_s']:>10.0f} triples/s  "
+                  f"{(result['peak_rss_bytes'] or 0) / 2**20:>7.1f} MB  {result['files']:>8} files",
+                  file=sys.stderr)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+# ----------------------------------------------------------------
+# Baseline comparison
+# ----------------------------------------------------------------
+
+def compare(results, baseline, threshold):
+    """Return one line per case that is slower, or uses more memory, than the baseline."""
+    previous = {(r["workload"], r["rows"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["workload"], result["rows"]))
+        if before is None:
+            continue
+        name = f"{result['workload']} @ {result['rows']} rows"
+        change = result["rows_per_s"] / before["rows_per_s"] - 1
+        if change < -threshold:
+            regressions.append(f"{name}: {before['rows_per_s']:.0f} -> {result['rows_per_s']:.0f} rows/s "
+                               f"({change:+.1%})")
+        if result["peak_rss_bytes"] and before["peak_rss_bytes"]:
+            growth = result["peak_rss_bytes"] / before["peak_rss_bytes"] - 1
+            if growth > threshold:
+                regressions.append(f"{name}: peak RSS {before['peak_rss_bytes'] / 2**20:.1f} -> "
+                                   f"{result['peak_rss_bytes'] / 2**20:.1f} MB ({growth:+.1%})")
+    return regressions
+
+
+def main():
+    settings = parser.parse_args()
+    if settings.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    os.makedirs(settings.work_dir, exist_ok=True)
+
+    report = {
+        "environment": environment(),
+        "settings": {k: v for k, v in vars(settings).items() if k not in UNRECORDED},
+        "results": run_benchmarks(settings),
+    }
+    with open(settings.out, "w") as stream:
+        json.dump(report, stream, indent=1)
+    print(f"Results written to {settings.out}", file=sys.stderr)
+
+    if settings.baseline:
+        with open(settings.baseline) as stream:
+            baseline = json.load(stream)
+        if baseline["settings"] != report["settings"]:
+            print("Warning: the baseline was recorded with different settings", file=sys.stderr)
+        regressions = compare(report["results"], baseline, settings.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Kastle Foundry: generate RDF knowledge graphs from a YAML mapping and CSV/XML data.
+
+    import kastle_foundry
+
+    mapping = kastle_foundry.load_mapping("mapping.yaml")
+    compiled = kastle_foundry.compile(mapping, "http://example.org/", prefix="ex")
+    rows = compiled.read("data.csv")  # or any iterable of dicts
+    kastle_foundry.write(compiled.transform(rows), "out.nt", fmt="nt", prefixes=compiled.prefixes)
+
+Importing the package has no side effects, and rdflib/yaml are only
+imported when the names that need them are first used.
+"""
+import importlib
+
+# Public name -> (module, attribute)
+_exports = {
+    "load_mapping": ("mapping", "load_mapping"),
+    "compile": ("plan", "compile_mapping"),
+    "compile_mapping": ("plan", "compile_mapping"),
+    "CompiledMapping": ("plan", "CompiledMapping"),
+    "Prefixes": ("terms", "Prefixes"),
+    "write": ("output", "write"),
+    "OutputSettings": ("output", "OutputSettings"),
+    "TripleDeduplicator": ("dedup", "TripleDeduplicator"),
+    "RunMetrics": ("metrics", "RunMetrics"),
+    "find_inputs": ("inputs", "find_inputs"),
+    "run": ("run", "run"),
+    "MappingCache": ("serve", "MappingCache"),
+    "MultiMapping": ("multi", "MultiMapping"),
+    "MultiOutput": ("multi", "MultiOutput"),
+    "main": ("cli", "main"),
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    try:
+        module, attribute = _exports[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    value = getattr(importlib.import_module(f".{module}", __name__), attribute)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
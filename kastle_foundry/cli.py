@@ -0,0 +1,358 @@
+"""
+Command-line interface. Only argparse is imported up front; the mapping,
+rdflib and output modules are imported once the arguments are valid.
+"kastle-foundry.py serve ..." runs jobs from a warm process (see serve.py).
+"""
+import argparse
+import logging
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def build_parser(parser_class=argparse.ArgumentParser):
+    parser = parser_class(
+        description="Generate RDF knowledge graphs from a mapping and CSV/XML data."
+    )
+    parser.add_argument(
+        "-m", "--mapping",
+        required=True,
+        action="extend",
+        nargs="+",
+        help="Path to the YAML mapping file; several mappings (-m a.yaml b.yaml, or -m given more than once) "
+             "are applied in one read pass of the data, each to <output-dir>/<mapping name>"
+    )
+    parser.add_argument(
+        "--merge-outputs",
+        action="store_true",
+        help="With several mappings, write all their triples to one output in --output-dir"
+    )
+    parser.add_argument(
+        "-d", "--data",
+        required=True,
+        help="Path to the input data file (CSV or XML), or a directory containing CSV/XML files"
+    )
+    parser.add_argument(
+        "-o", "--output-dir",
+        default="output",
+        help="Directory to write output Turtle files"
+    )
+    parser.add_argument(
+        "--namespace", "--n",
+        required=True,
+        help="Base namespace URI"
+    )
+    parser.add_argument(
+        "--prefix",
+        default="ex",
+        help="Prefix to use for the base namespace (default: ex)"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["ttl", "nt", "nq", "ttl-stream"],
+        default="ttl",
+        help="Output format: 'ttl' (one pretty-printed Turtle graph per row), or a streaming "
+             "format written straight to one file per input: 'nt' (N-Triples), 'nq' (N-Quads) "
+             "or 'ttl-stream' (Turtle grouped by subject, no sorting) (default: ttl)"
+    )
+    parser.add_argument(
+        "--layout",
+        choices=["row", "file", "shard", "partition"],
+        help="Output file layout: 'row' (one file per row), 'file' (one file per input file), "
+             "'shard' (roll over to a new file every --shard-triples/--shard-bytes) "
+             "or 'partition' (--partitions files, by subject) "
+             "(default: row for ttl, file for the streaming formats)"
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        help="Route every triple to one of this many files per input by a stable hash of its subject, "
+             "for parallel bulk loading (implies --layout partition)"
+    )
+    parser.add_argument(
+        "--shard-triples",
+        type=int,
+        help="Start a new shard once a shard holds at least this many triples (implies --layout shard)"
+    )
+    parser.add_argument(
+        "--shard-bytes",
+        type=int,
+        help="Start a new shard once a shard holds at least this many bytes, before compression "
+             "(implies --layout shard; streaming formats only)"
+    )
+    parser.add_argument(
+        "--graph",
+        help="Graph name for N-Quads output, as a URI or prefixed name "
+             "(default: <prefix>-r:graph.<input_basename>)"
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        help="Compress output files with gzip (.gz) or zstd (.zst, needs the zstandard package), "
+             "on a background thread"
+    )
+    parser.add_argument(
+        "--delta",
+        choices=["nt", "sparql"],
+        help="Incremental mode: compare each row with the previous run (state kept in <output-dir>/foundry-state) "
+             "and write only the triples inserted and deleted since, as delta-<input>.insert.nt and "
+             "delta-<input>.delete.nt ('nt') or one SPARQL Update, delta-<input>.ru ('sparql')"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to transform rows and files (default: 1)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Rows read and transformed per batch, and per work unit sent to a worker (default: 1000)"
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=2,
+        help="Batches read ahead, and waiting to be written, on threads of their own while rows are "
+             "transformed; 0 runs every stage in turn on one thread (default: 2)"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["auto", "columnar", "row"],
+        default="auto",
+        help="How CSV rows are transformed: 'columnar' (in column batches), 'row' (one row at a time), "
+             "or 'auto' (columnar unless the mapping uses foreach) (default: auto)"
+    )
+    parser.add_argument(
+        "--term-cache",
+        type=int,
+        default=4096,
+        help="URIs and literals kept per mapping node, so values repeated across rows are built once; "
+             "0 turns interning off (default: 4096)"
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Drop triples that were already emitted anywhere in the run"
+    )
+    parser.add_argument(
+        "--dedup-memory",
+        type=int,
+        default=256,
+        help="Memory budget in MB for --dedup fingerprints before they spill to disk (default: 256)"
+    )
+    parser.add_argument(
+        "--dedup-dir",
+        help="Directory for --dedup spill files (default: the system temp directory)"
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Ignore the checkpoint manifest in the output directory and process every input again"
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=10000,
+        help="Rows between checkpoints recorded in the run manifest (default: 10000)"
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="Write run metrics (stage timings, per-file rates, per-node counts, peak RSS) to this JSON file"
+    )
+    parser.add_argument(
+        "--diagnostics-out",
+        help="Write the run's row issues (per mapping node: issue, level, row count and sample subjects) "
+             "to this JSON file; they are also logged as one table at the end of the run"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Collect metrics, profile the run with cProfile, and print a summary to stderr"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="Enable verbose logging (DEBUG level)"
+    )
+    parser.add_argument(
+        "--log-file",
+        help="Log file name (if omitted, logs go to stderr)"
+    )
+
+    return parser
+
+
+def parse_args(argv=None, parser_class=argparse.ArgumentParser):
+    parser = build_parser(parser_class)
+    cli_args = parser.parse_args(argv)
+
+    if cli_args.workers < 1 or cli_args.batch_size < 1 or cli_args.checkpoint_every < 1:
+        parser.error("--workers, --batch-size and --checkpoint-every must be at least 1")
+    if cli_args.pipeline_depth < 0:
+        parser.error("--pipeline-depth must be at least 0")
+    if cli_args.term_cache < 0:
+        parser.error("--term-cache must be at least 0")
+    if cli_args.delta is not None:
+        if (cli_args.layout is not None or cli_args.partitions is not None
+                or cli_args.shard_triples is not None or cli_args.shard_bytes is not None):
+            parser.error("--delta writes its own files, so it cannot be combined with --layout, --partitions "
+                         "or --shard-triples/--shard-bytes")
+        # ttl is the default, so it is taken to mean "not given"
+        if cli_args.format not in ("ttl", "nt"):
+            parser.error("--delta writes N-Triples, so --format must be nt")
+        if cli_args.dedup:
+            parser.error("--delta cannot be combined with --dedup")
+        cli_args.format = "nt"
+        cli_args.layout = "delta"
+    if cli_args.shard_triples is not None or cli_args.shard_bytes is not None:
+        if cli_args.layout not in (None, "shard"):
+            parser.error("--shard-triples/--shard-bytes require --layout shard")
+        cli_args.layout = "shard"
+    if cli_args.partitions is not None:
+        if cli_args.partitions < 1:
+            parser.error("--partitions must be at least 1")
+        if cli_args.layout not in (None, "partition"):
+            parser.error("--partitions requires --layout partition")
+        cli_args.layout = "partition"
+    elif cli_args.layout == "partition":
+        parser.error("--layout partition requires --partitions")
+    if cli_args.layout is None:
+        cli_args.layout = "row" if cli_args.format == "ttl" else "file"
+    if cli_args.layout == "shard":
+        if cli_args.shard_triples is None and cli_args.shard_bytes is None:
+            parser.error("--layout shard requires --shard-triples and/or --shard-bytes")
+        if cli_args.shard_bytes is not None and cli_args.format == "ttl":
+            parser.error("--shard-bytes requires a streaming format (nt, nq or ttl-stream)")
+    if len(cli_args.mapping) > 1 and not cli_args.merge_outputs:
+        from .multi import mapping_names
+        names = mapping_names(cli_args.mapping)
+        if len(set(names)) < len(names):
+            parser.error("Mappings written to separate outputs need distinct file names (or use --merge-outputs)")
+    if cli_args.compress is not None:
+        from .compression import available_compressions
+        if cli_args.compress not in available_compressions():
+            parser.error(f"--compress {cli_args.compress} requires the zstandard package")
+    return cli_args
+
+
+def configure_logging(cli_args):
+    log_level = logging.DEBUG if cli_args.verbose else logging.WARNING
+
+    logging_kwargs = {
+        "level": log_level,
+        "format": "%(asctime)s - %(levelname)s - %(message)s",
+    }
+
+    if cli_args.log_file:
+        logging_kwargs["filename"] = cli_args.log_file
+        logging_kwargs["filemode"] = "w"  # overwrite each run
+
+    logging.basicConfig(**logging_kwargs)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["serve"]:
+        from .serve import main as serve_main
+        return serve_main(argv[1:])
+    cli_args = parse_args(argv)
+    configure_logging(cli_args)
+    run_job(cli_args)
+
+
+def run_job(cli_args, mappings=None):
+    """
+    Run the Foundry for parsed arguments. mappings is an optional
+    MappingCache (see serve.py) to take the compiled mappings from.
+    Returns the job's timings: mapping load and compile time, run time, and
+    whether the compiled mappings all came from the cache.
+    """
+    import cProfile
+    import json
+
+    from .dedup import TripleDeduplicator
+    from .inputs import find_inputs
+    from .mapping import load_mapping
+    from .metrics import RunMetrics, print_metrics_summary
+    from .multi import MultiDeduplicator, MultiMapping, MultiOutput, mapping_names
+    from .output import OutputSettings
+    from .plan import compile_mapping
+    from .run import run
+
+    started = time.perf_counter()
+    cached = False
+    if mappings is not None:
+        entries = [mappings.get(path, cli_args.namespace, cli_args.prefix, cli_args.term_cache)
+                   for path in cli_args.mapping]
+        compiled_mappings = [compiled for compiled, _ in entries]
+        cached = all(hit for _, hit in entries)
+        data_paths = find_inputs(cli_args.data)
+        logger.info(f"Opening: {cli_args.data}")
+    else:
+        loaded = [load_mapping(path) for path in cli_args.mapping]
+        data_paths = find_inputs(cli_args.data)
+        logger.info(f"Opening: {cli_args.data}")
+        compiled_mappings = [compile_mapping(mapping, cli_args.namespace, cli_args.prefix, cli_args.term_cache)
+                             for mapping in loaded]
+    compiled = compiled_mappings[0]
+    output = OutputSettings(cli_args.output_dir, compiled.prefixes, cli_args.format, cli_args.layout,
+                            cli_args.shard_triples, cli_args.shard_bytes, cli_args.graph, cli_args.compress,
+                            cli_args.partitions, cli_args.delta)
+    if len(compiled_mappings) > 1:
+        # Several mappings share one read pass of the data
+        names = mapping_names(cli_args.mapping)
+        compiled = MultiMapping(compiled_mappings, names, merged=cli_args.merge_outputs)
+        if not cli_args.merge_outputs:
+            output = MultiOutput(output, names)
+    compiled_at = time.perf_counter()
+
+    metrics = None
+    if cli_args.metrics_out or cli_args.profile:
+        metrics = RunMetrics(compiled.roots)
+    dedup = None
+    if cli_args.dedup:
+        dedup_memory = cli_args.dedup_memory * 1024 * 1024
+        if isinstance(output, MultiOutput):
+            # Each separate output is deduplicated on its own, within a share of the budget
+            dedup = MultiDeduplicator([TripleDeduplicator(dedup_memory // len(output.names), cli_args.dedup_dir)
+                                       for _ in output.names])
+        else:
+            dedup = TripleDeduplicator(dedup_memory, cli_args.dedup_dir)
+        if not cli_args.no_resume:
+            # The fingerprints of earlier runs are not kept, so nothing can be skipped
+            logger.info("Resuming is not supported with --dedup, processing every input.")
+    if cli_args.delta is not None and not cli_args.no_resume:
+        logger.info("With --delta every input is read again; unchanged rows are skipped by their fingerprints.")
+    profiler = cProfile.Profile() if cli_args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run(compiled, data_paths, output, cli_args.workers, cli_args.batch_size, cli_args.checkpoint_every,
+            dedup=dedup, resume=not cli_args.no_resume, metrics=metrics, engine=cli_args.engine,
+            pipeline_depth=cli_args.pipeline_depth)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if dedup is not None:
+            dedup.close()
+        if cli_args.diagnostics_out:
+            with open(cli_args.diagnostics_out, "w") as stream:
+                json.dump(compiled.diagnostics_report(), stream, indent=1)
+        if metrics is not None:
+            report = metrics.report(profiler)
+            # The compiled mapping may be reused by a later job without metrics
+            metrics.detach()
+            if cli_args.metrics_out:
+                with open(cli_args.metrics_out, "w") as stream:
+                    json.dump(report, stream, indent=1)
+            if cli_args.profile:
+                print_metrics_summary(report)
+    return {
+        "cached": cached,
+        "compile_s": compiled_at - started,
+        "run_s": time.perf_counter() - compiled_at,
+    }
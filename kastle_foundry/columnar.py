@@ -0,0 +1,323 @@
+"""
+Columnar execution for CSV input.
+
+CSV files are read in batches of rows that are kept as columns, and the
+compiled plan is evaluated one column at a time: each varid column is
+quoted once per batch and shared by every instance node that uses it, each
+instance URI pattern is built once per batch, and each val_source column is
+stripped once and encoded in one pass by its LiteralCodec, through the
+node's term cache while its values repeat (see interning.py). Per-row work
+is then only stitching precomputed terms into triples. The output (triples,
+their order, and the log messages) is the same as applying the plan row by
+row.
+
+Mappings with foreach connections, and XML input, use the row-at-a-time
+path instead. When pyarrow is installed it parses the CSV; otherwise the
+csv module does. Either way a file reads as csv.DictReader reads it: a
+header with duplicate column names, and the rows from the first with a
+different number of fields than the header on, go to the csv module.
+"""
+import csv
+import itertools
+import logging
+
+from urllib.parse import quote
+
+from .compression import compression_of, open_data
+from .mapping import log_message_with_node
+from .plan import ConstantPlan, InstancePlan, LiteralPlan, RowTriples, iter_plan_nodes
+from .terms import a
+
+try:
+    import pyarrow
+    import pyarrow.csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnBatch:
+    """A batch of CSV rows, as {column name: [value per row]} for the columns the mapping reads."""
+    __slots__ = ("columns", "size")
+
+    def __init__(self, columns, size):
+        self.columns = columns
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+# ----------------------------------------------------------------
+# Reading
+# ----------------------------------------------------------------
+
+def read_csv_header(data_path):
+    with open_data(data_path, "r", encoding='utf-8-sig') as data_stream:
+        return next(csv.reader(data_stream), None)
+
+
+def iter_csv_batches(data_path, columns, start=0, batch_size=1000):
+    """Yield ColumnBatches of the named columns, skipping the first start rows."""
+    if pyarrow is not None:
+        header = read_csv_header(data_path)
+        if header is None:
+            return
+        # pyarrow keeps the first of duplicate column names, where csv.DictReader keeps the last
+        if len(set(header)) == len(header):
+            read = yield from iter_csv_batches_arrow(data_path, header, columns, start, batch_size)
+            if read is None:
+                return
+            # A row pyarrow cannot read as csv.DictReader does: the csv module reads on from it
+            start = read
+    with open_data(data_path, "r", encoding='utf-8-sig') as data_stream:
+        logger.info("CSV Open success.")
+        reader = csv.reader(data_stream)
+        header = next(reader, None)
+        logger.info("CSV Load success.")
+        if header is None:
+            return
+        # Later duplicates of a column name win, as with csv.DictReader
+        index = {name: i for i, name in enumerate(header)}
+        wanted = [(name, index[name]) for name in columns if name in index]
+        width = len(header)
+        # csv.DictReader skips blank lines, so they are not rows
+        rows = (row for row in reader if row)
+        if start:
+            rows = itertools.islice(rows, start, None)
+        while True:
+            chunk = list(itertools.islice(rows, batch_size))
+            if not chunk:
+                return
+            if any(len(row) < width for row in chunk):
+                # Short rows read as None, like csv.DictReader's restval
+                chunk = [row + [None] * (width - len(row)) for row in chunk]
+            yield ColumnBatch({name: [row[i] for row in chunk] for name, i in wanted}, len(chunk))
+
+
+def iter_csv_batches_arrow(data_path, header, columns, start, batch_size):
+    """
+    iter_csv_batches() through pyarrow. pyarrow fails on a row with more or
+    fewer fields than the header, which csv.DictReader pads (or truncates):
+    the rows before it are yielded, and the index of the first row still to
+    read is returned, for the csv module to read the rest. Returns None once
+    the whole file was read.
+    """
+    wanted = [name for name in dict.fromkeys(columns) if name in header]
+    invalid_rows = []
+
+    def invalid_row(row):
+        invalid_rows.append(row)
+        return "error"
+
+    # Compressed files are decompressed as they are read, as with the csv module
+    source = data_path if compression_of(data_path) is None else open_data(data_path)
+    read = 0
+    try:
+        # The first block is parsed here already
+        reader = pyarrow_csv.open_csv(
+            source,
+            parse_options=pyarrow_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=invalid_row),
+            convert_options=pyarrow_csv.ConvertOptions(
+                column_types={name: pyarrow.string() for name in header},
+                include_columns=wanted,
+                strings_can_be_null=False,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+        for record_batch in reader:
+            # Skipped here rather than with skip_rows_after_names, which counts
+            # blank lines and the lines of quoted newlines as rows
+            skip = min(max(start - read, 0), record_batch.num_rows)
+            read += skip
+            for offset in range(skip, record_batch.num_rows, batch_size):
+                chunk = record_batch.slice(offset, batch_size)
+                yield ColumnBatch({name: chunk.column(name).to_pylist() for name in wanted}, chunk.num_rows)
+                read += chunk.num_rows
+    except pyarrow.ArrowInvalid:
+        if not invalid_rows:
+            raise
+        row = invalid_rows[0]
+        logger.debug(f"Row with {row.actual_columns} fields for {row.expected_columns} columns, "
+                     f"reading on with the csv module: {data_path}")
+        return max(read, start)
+    finally:
+        if source is not data_path:
+            source.close()
+    return None
+
+
+# ----------------------------------------------------------------
+# Batch plan
+# ----------------------------------------------------------------
+
+class LinkStep:
+    """The links of one connection, in the order the row path emits them."""
+    __slots__ = ("subject", "target", "preds", "inv", "connection")
+
+    def __init__(self, subject, target, preds, inv, connection):
+        self.subject = subject
+        self.target = target
+        self.preds = preds
+        self.inv = inv
+        self.connection = connection
+
+
+class BatchPlan:
+    """A compiled plan, rearranged to be evaluated column by column."""
+
+    def __init__(self, root):
+        self.root = root
+        self.nodes = list(iter_plan_nodes(root))
+        self.instances = [n for n in self.nodes if isinstance(n, InstancePlan)]
+        self.literals = [n for n in self.nodes if isinstance(n, LiteralPlan)]
+        # Type and link steps, in the depth-first order InstancePlan.apply() emits
+        self.steps = []
+        self.add_steps(root)
+        columns = {}
+        for node in self.instances:
+            columns.update(dict.fromkeys(node.varids or ()))
+        for node in self.literals:
+            columns.update(dict.fromkeys(node.sources))
+        self.columns = list(columns)
+
+    def add_steps(self, node):
+        if node.types:
+            self.steps.append((node, node.types))
+        for connection in node.connections:
+            if isinstance(connection.target, InstancePlan):
+                self.add_steps(connection.target)
+            self.steps.append(LinkStep(node, connection.target, connection.preds,
+                                       connection.inv, connection))
+
+    def transform(self, batch):
+        """Return the triples of every row of the batch, one RowTriples per row."""
+        n = batch.size
+        terms = self.evaluate(batch)
+        parts = []
+        for step in self.steps:
+            if isinstance(step, LinkStep):
+                parts.append(link_triples(terms[step.subject], terms[step.target], step.preds, step.inv))
+            else:
+                node, types = step
+                parts.append([tuple((s, a, t) for t in types) for s in terms[node]])
+        subjects = terms[self.root]
+        if parts:
+            rows = [RowTriples(itertools.chain.from_iterable(row_parts), subject)
+                    for row_parts, subject in zip(zip(*parts), subjects)]
+        else:
+            rows = [RowTriples((), subject) for subject in subjects]
+        self.report(terms, n)
+        return rows
+
+    def evaluate(self, batch):
+        """Return {plan node: [term per row]} for every node of the plan."""
+        n = batch.size
+        columns = batch.columns
+        quoted = {}
+        stripped = {}
+        uris = {}
+        terms = {}
+        for node in self.nodes:
+            if isinstance(node, ConstantPlan):
+                terms[node] = [node.uri] * n
+            elif isinstance(node, LiteralPlan):
+                terms[node] = literal_column(node, columns, stripped, n)
+            else:
+                if node.pattern not in uris:
+                    uris[node.pattern] = instance_column(node, columns, quoted, n)
+                terms[node] = uris[node.pattern]
+        return terms
+
+    def report(self, terms, n):
+        """Record empty literal targets exactly as the row path would, and update node stats."""
+        missing = [(step, terms[step.target]) for step in self.steps
+                   if isinstance(step, LinkStep) and isinstance(step.target, LiteralPlan)]
+        # Literal.__eq__ is slow, so compare by identity rather than with `None in targets`
+        missing = [(step, targets) for step, targets in missing if any(t is None for t in targets)]
+        for step, targets in missing:
+            subjects = terms[step.subject]
+            subjects = [subjects[i] for i, t in enumerate(targets) if t is None]
+            diagnostics = step.subject.diagnostics
+            if step.connection.empty_literal:
+                diagnostics.empty_value(step.target, subjects)
+            diagnostics.no_target(step.connection, subjects)
+        if self.root.stats is None:
+            return
+        for node in self.nodes:
+            node.stats.applied += n
+        for node, types in (step for step in self.steps if not isinstance(step, LinkStep)):
+            node.stats.triples += len(types) * n
+        for step in self.steps:
+            if not isinstance(step, LinkStep):
+                continue
+            empty = sum(t is None for t in terms[step.target])
+            target_stats = step.target.stats
+            if isinstance(step.target, LiteralPlan) and step.target.sources:
+                target_stats.skipped += empty
+                target_stats.warnings += empty
+            step.subject.stats.warnings += empty
+            links = len(step.preds) + (step.inv is not None)
+            step.subject.stats.triples += links * (n - empty)
+
+
+def instance_column(node, columns, quoted, n):
+    if node.varids is None:
+        return [node.uri] * n
+    for varid in node.varids:
+        if varid not in columns:
+            msg = "Variable ID missing from data file"
+            log_message_with_node(msg, node.node, error_type="error")
+            raise Exception(msg)
+    if node.terms.active:
+        get = node.terms.get
+        return [get(values) for values in zip(*[columns[varid] for varid in node.varids])]
+    varid_columns = []
+    for varid in node.varids:
+        if varid not in quoted:
+            quoted[varid] = [quote(v, safe="") for v in columns[varid]]
+        varid_columns.append(quoted[varid])
+    prefix = node.base + "."
+    suffix = node.suffix
+    make_uri = node.make_uri
+    if len(varid_columns) == 1:
+        return [make_uri(prefix + v + suffix) for v in varid_columns[0]]
+    return [make_uri(prefix + ".".join(vs) + suffix) for vs in zip(*varid_columns)]
+
+
+def literal_column(node, columns, stripped, n):
+    if not node.sources:
+        return [node.constant] * n
+    source_columns = []
+    for source in node.sources:
+        if source not in stripped:
+            column = columns.get(source)
+            # Missing columns read as "", like row.get(source, "")
+            stripped[source] = [""] * n if column is None else [v.strip() if v else v for v in column]
+        source_columns.append(stripped[source])
+    if len(source_columns) == 1:
+        return node.codec.encode_column(source_columns[0])
+    # The first non-empty val_source wins
+    return node.codec.encode_column([next((v for v in vals if v), None) for vals in zip(*source_columns)])
+
+
+def link_triples(subjects, targets, preds, inv):
+    if inv is None:
+        if len(preds) == 1:
+            p = preds[0]
+            return [((s, p, o),) if o is not None else () for s, o in zip(subjects, targets)]
+        return [tuple((s, p, o) for p in preds) if o is not None else ()
+                for s, o in zip(subjects, targets)]
+    return [tuple((s, p, o) for p in preds) + ((o, inv, s),) if o is not None else ()
+            for s, o in zip(subjects, targets)]
+
+
+def compile_batch_plan(root):
+    """Return a BatchPlan for the plan, or None if it needs the row-at-a-time path."""
+    if not isinstance(root, InstancePlan):
+        return None
+    for node in iter_plan_nodes(root):
+        if any(c.foreach is not None for c in getattr(node, "connections", ())):
+            return None
+    return BatchPlan(root)
@@ -0,0 +1,196 @@
+"""
+Compressed output files, and reading compressed input files.
+
+Output is compressed on a background thread: the main thread hands over
+chunks of serialized output and goes back to generating triples while the
+thread compresses and writes them (zlib and zstandard release the GIL while
+they compress). Each checkpoint ends the current gzip member (or zstd
+frame), so a file truncated at a checkpoint is still a valid compressed
+file and a resumed run can append to it.
+
+zstd needs the optional zstandard package.
+"""
+import gzip
+import io
+import logging
+import queue
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESS_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# Uncompressed bytes collected before a chunk is handed to the compressor thread
+CHUNK_SIZE = 1 << 20
+
+# Chunks queued for the compressor thread before write() blocks
+QUEUE_CHUNKS = 4
+
+
+def available_compressions():
+    """The --compress choices usable in this environment."""
+    return [name for name in COMPRESS_EXTENSIONS if name != "zstd" or zstandard is not None]
+
+
+def new_compressor(compress):
+    """A compressor object with compress(data) and flush(), writing one gzip member or zstd frame."""
+    if compress == "gzip":
+        # wbits 31: a zlib stream with a gzip header and trailer
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compress == "zstd":
+        if zstandard is None:
+            msg = "zstd compression requires the zstandard package"
+            logger.error(msg)
+            raise Exception(msg)
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise Exception(f"Unknown compression: {compress}")
+
+
+class CompressedStream:
+    """
+    A binary output stream compressed on a background thread. raw is the
+    file the compressed data goes to; it is closed with the stream.
+    """
+
+    def __init__(self, raw, compress):
+        self.raw = raw
+        self.compress = compress
+        self.compressor = new_compressor(compress)
+        self.chunks = []
+        self.buffered = 0
+        # True once data has gone into the current member/frame
+        self.started = False
+        self.queue = None
+        self.thread = None
+        self.error = None
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= CHUNK_SIZE:
+            self.submit(False)
+        return len(data)
+
+    def submit(self, end):
+        """Hand the buffered data to the compressor thread; with end, close the member/frame after it."""
+        if self.error is not None:
+            raise self.error
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.buffered = 0
+        self.started = self.started or bool(data)
+        if end:
+            if not self.started:
+                return
+            self.started = False
+        if self.thread is None:
+            # Small files are compressed inline rather than starting a thread
+            if end:
+                self.compress_chunk(data, end)
+                return
+            self.queue = queue.Queue(QUEUE_CHUNKS)
+            self.thread = threading.Thread(target=self.compress_chunks, daemon=True)
+            self.thread.start()
+        self.queue.put((data, end))
+
+    def compress_chunk(self, data, end):
+        out = self.compressor.compress(data)
+        if end:
+            out += self.compressor.flush()
+            self.compressor = new_compressor(self.compress)
+        self.raw.write(out)
+
+    def compress_chunks(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.compress_chunk(*item)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        if self.thread is not None:
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def flush(self):
+        """End the current member/frame and write out everything written so far."""
+        self.submit(True)
+        self.wait()
+        self.raw.flush()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def tell(self):
+        """The length of the compressed data on disk; accurate after flush()."""
+        return self.raw.tell()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def abort(self):
+        """Close without writing out buffered data."""
+        self.chunks = []
+        self.stop()
+        self.raw.close()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.stop()
+            self.raw.close()
+
+
+def compression_of(path):
+    """The compression of a file, from its extension (None if uncompressed)."""
+    lower = path.lower()
+    for compress, ext in COMPRESS_EXTENSIONS.items():
+        if lower.endswith(ext):
+            return compress
+    return None
+
+
+def strip_compression(path):
+    """The path without its compression extension, e.g. quakes.csv.gz -> quakes.csv."""
+    compress = compression_of(path)
+    if compress is None:
+        return path
+    return path[:-len(COMPRESS_EXTENSIONS[compress])]
+
+
+def open_data(path, mode="rb", **kwargs):
+    """
+    Open an input file, decompressing .gz and .zst files as they are read.
+    mode is "rb" or "r" (kwargs such as encoding apply to text mode).
+    """
+    compress = compression_of(path)
+    if compress is None:
+        return open(path, mode, **kwargs)
+    if compress == "gzip":
+        return gzip.open(path, "rt" if mode == "r" else mode, **kwargs)
+    if zstandard is None:
+        msg = f"Reading {path} requires the zstandard package"
+        logger.error(msg)
+        raise Exception(msg)
+    # Outputs of a resumed run hold several frames, so read across them
+    stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+    if mode == "r":
+        return io.TextIOWrapper(stream, **kwargs)
+    return stream
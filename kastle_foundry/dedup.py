@@ -0,0 +1,123 @@
+"""Run-wide triple deduplication (--dedup) within a bounded memory budget."""
+import array
+import bisect
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import tempfile
+
+from .output import nt_term
+
+logger = logging.getLogger(__name__)
+
+# Shared nodes (ref nodes, constant targets, cv links, fixed values) are
+# re-emitted by every row. With --dedup, each triple is reduced to a 64-bit
+# fingerprint and dropped if that fingerprint was already seen in the run.
+# Fingerprints live in a set until the memory budget is reached, then
+# spill to sorted run files on disk that are binary-searched through mmap.
+# A 64-bit fingerprint can collide; at 10^8 distinct triples the chance
+# of dropping even one triple wrongly is about 3 in 10,000.
+
+def triple_fingerprint(triple):
+    s, p, o = triple
+    key = f"{nt_term(s)} {nt_term(p)} {nt_term(o)}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class TripleDeduplicator:
+    """Drop triples already emitted in this run, within a fixed memory budget."""
+
+    # Rough size of one fingerprint held in a Python set
+    ENTRY_BYTES = 72
+    # Merge the newest runs into one once this many of them are the same size.
+    # Every spill is max_entries long, so runs grow in tiers, each this many
+    # times the size of the one below: a fingerprint is rewritten once per
+    # tier (O(log n) times), and a lookup searches a few runs per tier.
+    MERGE_FANOUT = 4
+
+    def __init__(self, memory_limit, spill_dir=None):
+        self.max_entries = max(1, memory_limit // self.ENTRY_BYTES)
+        self.spill_dir = spill_dir
+        self.tmp = None
+        self.recent = set()
+        self.runs = []
+        self.spills = 0
+        self.kept = 0
+        self.dropped = 0
+
+    def seen(self, fp):
+        if fp in self.recent:
+            return True
+        for _, _, view in self.runs:
+            i = bisect.bisect_left(view, fp)
+            if i < len(view) and view[i] == fp:
+                return True
+        return False
+
+    def filter(self, triples):
+        out = []
+        for triple in triples:
+            fp = triple_fingerprint(triple)
+            if self.seen(fp):
+                self.dropped += 1
+                continue
+            self.recent.add(fp)
+            self.kept += 1
+            out.append(triple)
+            if len(self.recent) >= self.max_entries:
+                self.spill()
+        return out
+
+    def open_run(self, path):
+        stream = open(path, "rb")
+        mm = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        return stream, mm, memoryview(mm).cast("Q")
+
+    def close_run(self, run):
+        stream, mm, view = run
+        view.release()
+        mm.close()
+        stream.close()
+        os.remove(stream.name)
+
+    def spill(self):
+        if self.tmp is None:
+            self.tmp = tempfile.TemporaryDirectory(prefix="foundry-dedup-", dir=self.spill_dir)
+        self.spills += 1
+        path = os.path.join(self.tmp.name, f"run-{self.spills}.bin")
+        with open(path, "wb") as stream:
+            array.array("Q", sorted(self.recent)).tofile(stream)
+        logger.info(f"Dedup: spilled {len(self.recent)} fingerprints to {path}")
+        self.recent = set()
+        self.runs.append(self.open_run(path))
+        fanout = self.MERGE_FANOUT
+        while len(self.runs) >= fanout and len({len(view) for _, _, view in self.runs[-fanout:]}) == 1:
+            self.merge_runs(fanout)
+
+    def merge_runs(self, count):
+        """Merge the newest count runs into one."""
+        runs = self.runs[-count:]
+        self.spills += 1
+        path = os.path.join(self.tmp.name, f"run-{self.spills}.bin")
+        with open(path, "wb") as stream:
+            chunk = array.array("Q")
+            for fp in heapq.merge(*(view for _, _, view in runs)):
+                chunk.append(fp)
+                if len(chunk) >= 1 << 16:
+                    chunk.tofile(stream)
+                    chunk = array.array("Q")
+            chunk.tofile(stream)
+        for run in runs:
+            self.close_run(run)
+        self.runs[-count:] = [self.open_run(path)]
+
+    def close(self):
+        for run in self.runs:
+            self.close_run(run)
+        self.runs = []
+        if self.tmp is not None:
+            self.tmp.cleanup()
+            self.tmp = None
+        logger.info(f"Dedup: kept {self.kept} triples, dropped {self.dropped} duplicates.")
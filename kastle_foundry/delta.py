@@ -0,0 +1,323 @@
+"""
+Row-level change data capture (--delta): writing only the triples inserted
+and deleted since the previous run.
+
+Each row is keyed by the term of the mapping's root node, the subject URI
+built from its varids. The state of the previous run of an input file,
+<output_dir>/foundry-state/<base>.state, holds for each key a fingerprint
+of the row's triples and the row's N-Triples lines. A row whose fingerprint
+is unchanged is not serialized at all; the lines of a row that changed or
+appeared are compared with its previous ones, and every line of a row that
+is no longer there is deleted. The changes go to:
+- nt:     delta-<base>.insert.nt and delta-<base>.delete.nt
+- sparql: delta-<base>.ru, a SPARQL Update (DELETE DATA, then INSERT DATA)
+
+Rows share triples (ref nodes, constant targets), so a line is only deleted
+if no row of the new run still has it. The first run, without a state,
+inserts everything. The state is replaced once an input file is complete,
+after its delta files, so an interrupted run leaves the previous state in
+place. Rows repeating a root subject are told apart by their order.
+"""
+import array
+import bisect
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from hashlib import blake2b
+
+from rdflib import Literal
+
+from .compression import COMPRESS_EXTENSIONS
+from .output import StreamSerializer, StreamWriter
+
+logger = logging.getLogger(__name__)
+
+STATE_DIR = "foundry-state"
+
+# A state file is the rows' N-Triples back to back, then an index of
+# (key, fingerprint, offset, length) per row, sorted by key, then a trailer
+STATE_MAGIC = b"FNDRYST1"
+STATE_TRAILER = struct.Struct("<8sQQ")
+INDEX_FIELDS = 4
+
+
+def hash64(data):
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), "little")
+
+
+def row_key(subject):
+    """The 64-bit key of a row, from the term of its root node."""
+    return hash64(str(subject).encode("utf-8"))
+
+
+def repeat_key(key, k):
+    """The key of the k-th repeat of a key within one run."""
+    return hash64(key.to_bytes(8, "little") + k.to_bytes(8, "little"))
+
+
+def row_fingerprint(triples):
+    """A 64-bit fingerprint of a row's triples, taken from the terms without serializing them."""
+    text = "\x00".join([f"{s} {p} \"{o}\"{o.datatype}@{o.language}" if isinstance(o, Literal) else f"{s} {p} {o}"
+                        for s, p, o in triples])
+    return hash64(text.encode("utf-8"))
+
+
+class PreviousState:
+    """The state written by the previous run of an input file, read through mmap; empty if there is none."""
+
+    def __init__(self, path):
+        self.count = 0
+        self.keys = ()
+        self.map = None
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as stream:
+            size = os.fstat(stream.fileno()).st_size
+            if size >= STATE_TRAILER.size:
+                self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map is None:
+            logger.warning(f"Ignoring an unreadable state file, every row counts as new: {path}")
+            return
+        magic, count, data_length = STATE_TRAILER.unpack_from(self.map, size - STATE_TRAILER.size)
+        if magic != STATE_MAGIC or data_length + count * INDEX_FIELDS * 8 + STATE_TRAILER.size != size:
+            logger.warning(f"Ignoring an unreadable state file, every row counts as new: {path}")
+            self.map.close()
+            self.map = None
+            return
+        self.count = count
+        self.index = memoryview(self.map)[data_length:size - STATE_TRAILER.size].cast("Q")
+        self.keys = self.index[0::INDEX_FIELDS]
+
+    def find(self, key):
+        """The position of key in the index, or None."""
+        i = bisect.bisect_left(self.keys, key)
+        if i < self.count and self.keys[i] == key:
+            return i
+        return None
+
+    def fingerprint(self, i):
+        return self.index[INDEX_FIELDS * i + 1]
+
+    def lines(self, i):
+        offset = self.index[INDEX_FIELDS * i + 2]
+        return self.map[offset:offset + self.index[INDEX_FIELDS * i + 3]]
+
+    def close(self):
+        if self.map is None:
+            return
+        self.keys.release()
+        self.index.release()
+        self.map.close()
+        self.map = None
+
+
+def iter_line_chunks(stream, size=1 << 24):
+    """Yield the lines of a binary stream, a list of whole lines at a time."""
+    rest = b""
+    for chunk in iter(lambda: stream.read(size), b""):
+        chunk = rest + chunk
+        end = chunk.rfind(b"\n") + 1
+        rest = chunk[end:]
+        yield chunk[:end].splitlines(keepends=True)
+    if rest:
+        yield [rest]
+
+
+class DeltaLayout:
+    """
+    Write the changes of the rows of one input file against its previous
+    state, used like an OutputLayout. Fragments are (key, fingerprint,
+    triple count, N-Triples bytes), the bytes being None for a row that is
+    unchanged against the first row with its key in the previous state.
+    Changes can only be worked out once every row has been seen, so an
+    interrupted file starts over.
+    """
+
+    def __init__(self, base, settings):
+        self.base = base
+        self.settings = settings
+        self.layout = "delta"
+        self.serializer = StreamSerializer("nt", settings.prefixes)
+        self.state_dir = os.path.join(settings.output_dir, STATE_DIR)
+        self.state_path = os.path.join(self.state_dir, f"{base}.state")
+        self.previous = PreviousState(self.state_path)
+        self.rows = 0
+        # Opened on the first write, so a worker can encode with a layout of its own
+        self.state = None
+
+    def resume(self, rows, state):
+        return 0
+
+    def encode(self, triples):
+        return self.encode_keyed(row_key(getattr(triples, "subject", None)), triples)
+
+    def encode_keyed(self, key, triples):
+        fingerprint = row_fingerprint(triples)
+        i = self.previous.find(key)
+        if i is not None and self.previous.fingerprint(i) == fingerprint:
+            return key, fingerprint, len(triples), None
+        return key, fingerprint, len(triples), self.serializer.serialize(dict.fromkeys(triples)).encode("utf-8")
+
+    def row_triples(self, triples):
+        return len(triples)
+
+    def fragment_triples(self, fragment):
+        return fragment[2]
+
+    def open(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.state = open(self.state_path + ".part", "wb", buffering=1 << 20)
+        self.state_size = 0
+        self.keys = array.array("Q")
+        self.fingerprints = array.array("Q")
+        self.offsets = array.array("Q")
+        self.lengths = array.array("Q")
+        # Keys of this run: positions in the previous state, or keys new to it
+        self.seen = bytearray(self.previous.count)
+        self.new_keys = set()
+        # The next repeat number of keys seen more than once
+        self.repeats = {}
+        self.deleted = set()
+        self.counts = dict.fromkeys(("added", "changed", "removed", "unchanged", "inserted", "deleted"), 0)
+        if self.settings.delta == "sparql":
+            # The inserts follow the deletes in the update, so they wait in a temporary file
+            self.inserts = tempfile.TemporaryFile(prefix="foundry-delta-", dir=self.state_dir)
+        else:
+            self.inserts = self.open_writer(f"delta-{self.base}.insert.nt")
+
+    def open_writer(self, output_file, header=b""):
+        output_path = os.path.join(self.settings.output_dir, output_file)
+        if self.settings.compress is not None:
+            output_path += COMPRESS_EXTENSIONS[self.settings.compress]
+        logger.info(f"Writing: {output_path}")
+        return StreamWriter(output_path, header, compress=self.settings.compress)
+
+    def write_cvs(self, cv_plans, dedup=None):
+        for i, (cv_type, cv_triples) in enumerate(cv_plans):
+            logger.info(f"Serializing the cv fragment: '{cv_type}'")
+            self.apply(self.encode_keyed(row_key(f"cv:{i}:{cv_type}"), cv_triples))
+
+    def write_row(self, j, fragment):
+        self.rows = j + 1
+        self.apply(fragment)
+
+    def apply(self, fragment):
+        if self.state is None:
+            self.open()
+        key, fingerprint, _, data = fragment
+        previous, seen, counts = self.previous, self.seen, self.counts
+        i = first = previous.find(key)
+        if (i is not None and seen[i]) or key in self.new_keys:
+            k = self.repeats.get(key, 1)
+            self.repeats[key] = k + 1
+            key = repeat_key(key, k)
+            i = previous.find(key)
+        if i is not None:
+            seen[i] = 1
+        else:
+            self.new_keys.add(key)
+
+        if i is not None and previous.fingerprint(i) == fingerprint:
+            data = previous.lines(i)
+            counts["unchanged"] += 1
+        else:
+            if data is None:
+                # Encoded as unchanged against the first row with its key: the same lines
+                data = previous.lines(first)
+            lines = data.splitlines(keepends=True)
+            if i is None:
+                counts["added"] += 1
+                inserted = lines
+            else:
+                counts["changed"] += 1
+                old_lines = set(previous.lines(i).splitlines(keepends=True))
+                inserted = [line for line in lines if line not in old_lines]
+                self.deleted.update(old_lines.difference(lines))
+            if inserted:
+                counts["inserted"] += len(inserted)
+                if isinstance(self.inserts, StreamWriter):
+                    self.inserts.write((len(inserted), b"".join(inserted)))
+                else:
+                    self.inserts.write(b"".join(inserted))
+
+        self.keys.append(key)
+        self.fingerprints.append(fingerprint)
+        self.offsets.append(self.state_size)
+        self.lengths.append(len(data))
+        self.state.write(data)
+        self.state_size += len(data)
+
+    def checkpoint(self):
+        return 0, {}
+
+    def deleted_lines(self):
+        """The lines of the previous run that no row has any more, sorted."""
+        previous, seen, deleted = self.previous, self.seen, self.deleted
+        i = seen.find(0)
+        while i != -1:
+            self.counts["removed"] += 1
+            deleted.update(previous.lines(i).splitlines(keepends=True))
+            i = seen.find(0, i + 1)
+        if deleted:
+            # A line may still come from another row, unchanged or not
+            self.state.flush()
+            with open(self.state_path + ".part", "rb") as stream:
+                for lines in iter_line_chunks(stream):
+                    deleted.difference_update(lines)
+                    if not deleted:
+                        break
+        return sorted(deleted)
+
+    def write_delta(self, deleted):
+        if self.settings.delta == "nt":
+            self.inserts.close()
+            writer = self.open_writer(f"delta-{self.base}.delete.nt")
+            writer.write((len(deleted), b"".join(deleted)))
+            writer.close()
+            return
+        writer = self.open_writer(f"delta-{self.base}.ru", b"DELETE DATA {\n")
+        writer.write((len(deleted), b"".join(deleted)))
+        writer.write((0, b"} ;\nINSERT DATA {\n"))
+        self.inserts.seek(0)
+        for chunk in iter(lambda: self.inserts.read(1 << 20), b""):
+            writer.write((0, chunk))
+        writer.write((0, b"}\n"))
+        writer.close()
+        self.inserts.close()
+
+    def write_state(self):
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        index = array.array("Q")
+        for i in order:
+            index.extend((self.keys[i], self.fingerprints[i], self.offsets[i], self.lengths[i]))
+        self.state.write(index.tobytes())
+        self.state.write(STATE_TRAILER.pack(STATE_MAGIC, len(order), self.state_size))
+        self.state.close()
+        self.previous.close()
+        os.replace(self.state_path + ".part", self.state_path)
+
+    def abort(self):
+        """Stop without publishing anything; the previous state stays in place."""
+        if self.state is not None:
+            if isinstance(self.inserts, StreamWriter):
+                self.inserts.abort()
+            else:
+                self.inserts.close()
+            self.state.close()
+            self.state = None
+        self.previous.close()
+
+    def close(self):
+        if self.state is None:
+            self.open()
+        deleted = self.deleted_lines()
+        self.counts["deleted"] = len(deleted)
+        self.write_delta(deleted)
+        self.write_state()
+        self.state = None
+        counts = self.counts
+        logger.info(f"Delta of {self.base}: {counts['added']} rows added, {counts['changed']} changed, "
+                    f"{counts['removed']} removed, {counts['unchanged']} unchanged; "
+                    f"{counts['inserted']} triples inserted, {counts['deleted']} deleted.")
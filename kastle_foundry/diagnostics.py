@@ -0,0 +1,108 @@
+"""
+Issues met while applying a mapping to rows, aggregated per mapping node.
+
+A row that makes a node skip part of its output (a datatype node whose
+val_source is empty, a connection left without a target) is not logged
+on the spot, which for a large input would be most of the run's log and
+much of its CPU. Each distinct issue is counted per node instead, keeping
+the subjects of the first rows it was met in as samples, and reported once
+at the end of the run: as a table in the log, and as JSON with
+--diagnostics-out. With -v (DEBUG), every occurrence is logged as well.
+Messages are only formatted when the logger will emit them.
+"""
+import logging
+import re
+
+from .mapping import indent
+
+logger = logging.getLogger(__name__)
+
+# Subjects kept per issue, as samples of the rows it was met in
+MAX_SAMPLES = 3
+
+
+def path_order(item):
+    """Sort key for issues: by node path, with connections in mapping order, then by issue."""
+    (path, issue), _ = item
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)], issue
+
+
+def add_samples(samples, subjects):
+    for subject in subjects:
+        if len(samples) >= MAX_SAMPLES:
+            return
+        subject = str(subject)
+        if subject not in samples:
+            samples.append(subject)
+
+
+class Diagnostics:
+    """
+    The issues of one compiled mapping: {(node path, issue): [level, message,
+    count, samples]}. They are reported in mapping order, so the report is
+    the same whatever the engine and the number of workers.
+    """
+
+    def __init__(self):
+        self.issues = {}
+
+    def record(self, path, issue, level, message, subjects):
+        """Count an issue once per subject, for the rows with those subjects."""
+        entry = self.issues.get((path, issue))
+        if entry is None:
+            entry = self.issues[(path, issue)] = [level, message, 0, []]
+        entry[2] += len(subjects)
+        add_samples(entry[3], subjects)
+        if logger.isEnabledFor(logging.DEBUG):
+            for subject in subjects:
+                logger.debug(f"{message} ({path}): {subject}")
+
+    def empty_value(self, target, subjects):
+        """Rows in which the val_source of the datatype node target was empty."""
+        self.record(target.path, "empty-value", logging.ERROR if target.required else logging.WARNING,
+                    f"No value in '{', '.join(target.sources)}' for a datatype node", subjects)
+
+    def no_target(self, connection, subjects):
+        """Rows in which connection had no target, so its triples were skipped."""
+        preds = connection.node.get("p", "UNKNOWN_PREDICATE")
+        if isinstance(preds, list):
+            preds = ", ".join(preds)
+        self.record(connection.path, "no-target", logging.WARNING,
+                    f"Connection '{preds}' has no target URI, skipped", subjects)
+
+    def take(self):
+        """Return and reset the issues, to ship a worker's share to the parent."""
+        issues = self.issues
+        self.issues = {}
+        return issues
+
+    def merge(self, issues):
+        for key, (level, message, count, samples) in issues.items():
+            entry = self.issues.get(key)
+            if entry is None:
+                entry = self.issues[key] = [level, message, 0, []]
+            entry[2] += count
+            add_samples(entry[3], samples)
+
+    def report(self):
+        """The issues, one dict each, for --diagnostics-out."""
+        return [{"node": path, "issue": issue, "level": logging.getLevelName(level).lower(),
+                 "message": message, "rows": count, "samples": list(samples)}
+                for (path, issue), (level, message, count, samples) in sorted(self.issues.items(), key=path_order)]
+
+    def log(self, name=None):
+        """Log the issues as one table, at the level of the most severe one."""
+        if not self.issues:
+            return
+        level = max(entry[0] for entry in self.issues.values())
+        if not logger.isEnabledFor(level):
+            return
+        rows = [(f"{count}", logging.getLevelName(entry_level).lower(), path, message, ", ".join(samples))
+                for (path, _), (entry_level, message, count, samples) in sorted(self.issues.items(), key=path_order)]
+        header = ("rows", "level", "node", "issue", "e.g.")
+        widths = [max(len(row[i]) for row in rows + [header]) for i in range(4)]
+        lines = [f"Rows with issues, by mapping node{f' ({name})' if name else ''}:"]
+        for row in [header] + rows:
+            lines.append(indent + "  ".join([row[0].rjust(widths[0])] + [cell.ljust(width) for cell, width in
+                                                                          zip(row[1:4], widths[1:])] + [row[4]]))
+        logger.log(level, "\n".join(lines))
@@ -0,0 +1,393 @@
+"""Reading input rows from CSV and XML files."""
+import csv
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+from .compression import open_data, strip_compression
+from .mapping import collect_varids, iter_foreach_sources, iter_val_sources
+
+logger = logging.getLogger(__name__)
+
+INPUT_EXTENSIONS = (".csv", ".xml")
+
+
+def find_inputs(data_path):
+    """
+    Return the input files at data_path: the file itself, or the CSV/XML
+    files of a directory (including gzip or zstd compressed ones).
+    """
+    if not os.path.isdir(data_path):
+        return [data_path]
+    data_paths = sorted(
+        os.path.join(data_path, name)
+        for name in os.listdir(data_path)
+        if strip_compression(name).lower().endswith(INPUT_EXTENSIONS)
+    )
+    if not data_paths:
+        raise Exception(f"No CSV or XML files found in directory: {data_path}")
+    return data_paths
+
+
+def is_xml(data_path):
+    """Whether an input file is XML (otherwise it is read as CSV)."""
+    return strip_compression(data_path).lower().endswith(".xml")
+
+
+def iter_rows(data_path, xml_plan):
+    """Yield the rows of a CSV file, or the rows built from an XML file."""
+    if is_xml(data_path):
+        # Process the XML data
+        yield from build_rows_from_xml(data_path, xml_plan)
+        return
+    # Get the data out of the CSV file
+    with open_data(data_path, "r", encoding='utf-8-sig') as data_stream:
+        # Load the csv
+        logger.info("CSV Open success.")
+        reader = csv.DictReader(data_stream)
+        logger.info("CSV Load success.")
+        yield from reader
+
+
+def iter_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ----------------------------------------------------------------
+# Row types
+# ----------------------------------------------------------------
+
+class XmlRow(dict):
+    """A row built from an XML record; multi holds every value of the foreach sources."""
+    __slots__ = ("multi",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.multi = {}
+
+
+class BoundRow:
+    """A row seen through a foreach, with one source bound to a single value."""
+    __slots__ = ("row", "key", "value")
+
+    def __init__(self, row, key, value):
+        self.row = row
+        self.key = key
+        self.value = value
+
+    def get(self, key, default=None):
+        return self.value if key == self.key else self.row.get(key, default)
+
+    def __getitem__(self, key):
+        return self.value if key == self.key else self.row[key]
+
+
+def row_values(row, source, separator=None):
+    """Return every distinct, non-empty value of source in the row, in order."""
+    if isinstance(row, BoundRow):
+        if source == row.key:
+            return [row.value]
+        return row_values(row.row, source, separator)
+    multi = getattr(row, "multi", None)
+    if multi and source in multi:
+        # Every text of an XML source, each of which may hold several values
+        vals = multi[source]
+        if separator is None:
+            return vals
+    else:
+        val = row.get(source, "")
+        if not isinstance(val, str):
+            return [] if val is None else [val]
+        vals = [val]
+    if separator is not None:
+        vals = [v for val in vals for v in val.split(separator)]
+    vals = [v.strip() for v in vals if v.strip()]
+    return list(dict.fromkeys(vals))
+
+
+# ----------------------------------------------------------------
+# XML records
+# ----------------------------------------------------------------
+
+def xml_get_texts(xml_root, path):
+    """
+    Return list of text values for a simple slash-separated tag path.
+    Joins repeated leaf tags (e.g., multiple <Author> tags).
+    """
+    parts = [p for p in path.split("/") if p]
+    elems = [xml_root]
+    for part in parts:
+        next_elems = []
+        for e in elems:
+            next_elems.extend(list(e.findall(part)))
+        elems = next_elems
+        if not elems:
+            return []
+    out = []
+    for e in elems:
+        if e.text is not None:
+            t = e.text.strip()
+            if t != "":
+                out.append(t)
+    return out
+
+
+# ----------------------------------------------------------------
+# XML path plan
+# ----------------------------------------------------------------
+# Every varid and val_source path used by the mapping is compiled once per
+# run into a prefix trie of tag names. A record is then read in a single
+# walk that only descends into the branches the mapping actually uses.
+# Paths with ElementPath syntax beyond plain tags (e.g. "*", "..",
+# "[@attr]") fall back to the per-path lookups.
+
+class XmlPathNode:
+    """One tag in the path trie, with the varids/val_sources that end on it."""
+    __slots__ = ("children", "varids", "val_sources")
+
+    def __init__(self):
+        self.children = {}
+        self.varids = []
+        self.val_sources = []
+
+
+class XmlPlan:
+    """Compiled XML extraction for a mapping."""
+    __slots__ = ("record_path", "trie", "varids", "val_sources", "foreach_sources",
+                 "fallback_varids", "fallback_val_sources")
+
+    def __init__(self, record_path):
+        self.record_path = record_path
+        self.trie = XmlPathNode()
+        self.varids = []
+        self.val_sources = []
+        self.foreach_sources = set()
+        self.fallback_varids = []
+        self.fallback_val_sources = []
+
+
+def xml_path_parts(path):
+    """Split a path into plain tag names, or return None if it uses other ElementPath syntax."""
+    parts = [p for p in path.split("/") if p]
+    if not parts:
+        return None
+    for part in parts:
+        if part in (".", "..") or any(c in part for c in "[]*@{}()='\""):
+            return None
+    return parts
+
+
+def xml_trie_insert(trie, parts):
+    node = trie
+    for part in parts:
+        child = node.children.get(part)
+        if child is None:
+            child = node.children[part] = XmlPathNode()
+        node = child
+    return node
+
+
+def compile_xml_paths(mapping, lookups=None):
+    xml_plan = XmlPlan(mapping.get("record_path"))
+    # foreach sources need every value, so they are read like val_sources
+    foreach_sources = set(iter_foreach_sources(mapping))
+    varids = collect_varids(mapping)
+    val_sources = set(iter_val_sources(mapping)) | foreach_sources
+    if lookups is not None:
+        # Lookup columns are joined to the rows later; their keys are read instead
+        varids = {vid for vid in varids if vid not in lookups.sources} | set(lookups.key_sources)
+        val_sources = {vs for vs in val_sources if vs not in lookups.sources}
+    add_xml_paths(xml_plan, varids, val_sources)
+    xml_plan.foreach_sources = foreach_sources
+    return xml_plan
+
+
+def union_xml_plan(xml_plans):
+    """
+    One XmlPlan that extracts every varid and val_source of several mappings,
+    so a record is walked once for all of them. The mappings must agree on
+    the record_path.
+    """
+    record_paths = {xml_plan.record_path for xml_plan in xml_plans}
+    if len(record_paths) > 1:
+        msg = f"Mappings applied together must use the same record_path, not: {sorted(map(str, record_paths))}"
+        logger.error(msg)
+        raise Exception(msg)
+    union = XmlPlan(record_paths.pop())
+    add_xml_paths(union,
+                  {vid for xml_plan in xml_plans for vid in xml_plan.varids},
+                  {vs for xml_plan in xml_plans for vs in xml_plan.val_sources})
+    return union
+
+
+def add_xml_paths(xml_plan, varids, val_sources):
+    for vid in sorted(varids):
+        xml_plan.varids.append(vid)
+        parts = xml_path_parts(vid)
+        if parts is None:
+            xml_plan.fallback_varids.append(vid)
+        else:
+            xml_trie_insert(xml_plan.trie, parts).varids.append(vid)
+    for vs in sorted(val_sources):
+        xml_plan.val_sources.append(vs)
+        parts = xml_path_parts(vs)
+        if parts is None:
+            xml_plan.fallback_val_sources.append(vs)
+        else:
+            xml_trie_insert(xml_plan.trie, parts).val_sources.append(vs)
+
+
+def extract_xml_values(xr, xml_plan):
+    """
+    Walk a record once, returning ({varid: first text}, {val_source: [texts]}).
+    Varids follow Element.find() (first match, stripped text or ""), and
+    val_sources follow xml_get_texts() (every non-empty text, in document order).
+    """
+    varid_vals = {}
+    vs_texts = {vs: [] for vs in xml_plan.val_sources}
+
+    def visit(elem, node):
+        for vid in node.varids:
+            if vid not in varid_vals:
+                varid_vals[vid] = elem.text.strip() if elem.text else ""
+        if node.val_sources and elem.text is not None:
+            t = elem.text.strip()
+            if t != "":
+                for vs in node.val_sources:
+                    vs_texts[vs].append(t)
+        children = node.children
+        if children:
+            for child in elem:
+                child_node = children.get(child.tag)
+                if child_node is not None:
+                    visit(child, child_node)
+
+    visit(xr, xml_plan.trie)
+
+    for vid in xml_plan.fallback_varids:
+        el = xr.find(vid)
+        varid_vals[vid] = (el.text.strip() if (el is not None and el.text) else "")
+    for vs in xml_plan.fallback_val_sources:
+        vs_texts[vs] = xml_get_texts(xr, vs)
+    return varid_vals, vs_texts
+
+
+def iter_xml_records(xml_path, record_path):
+    """
+    Stream the elements found at record_path (a slash-separated tag path,
+    relative to the document root, e.g. "Records/Record") with iterparse.
+    Each record is cleared and detached once it has been consumed, so memory
+    stays flat however many records the file holds.
+    """
+    record_parts = [p for p in record_path.split("/") if p]
+    record_depth = len(record_parts) + 1
+    tags = []
+    elems = []
+    with open_data(xml_path) as xml_stream:
+        for event, elem in ET.iterparse(xml_stream, events=("start", "end")):
+            if event == "start":
+                tags.append(elem.tag)
+                elems.append(elem)
+                continue
+            is_record = len(tags) == record_depth and tags[1:] == record_parts
+            tags.pop()
+            elems.pop()
+            if is_record:
+                yield elem
+                elem.clear()
+                if elems:
+                    elems[-1].remove(elem)
+
+
+def build_rows_from_xml(xml_path, xml_plan):
+    """
+    Yield the rows of an XML file. Without a mapping-level 'record_path'
+    the whole document is one record; with it, every matching element is
+    a record and the file is streamed.
+    """
+    if xml_plan.record_path is None:
+        with open_data(xml_path) as xml_stream:
+            tree = ET.parse(xml_stream)
+        yield from build_rows_from_record(tree.getroot(), xml_plan)
+        return
+    for record in iter_xml_records(xml_path, xml_plan.record_path):
+        yield from build_rows_from_record(record, xml_plan)
+
+
+def build_record_rows_from_xml(xml_path, xml_plans):
+    """
+    Yield, for each record of an XML file, a tuple with the rows every
+    xml_plan builds from it. Each record is parsed and walked once,
+    whatever the number of plans.
+    """
+    union = union_xml_plan(xml_plans)
+    if union.record_path is None:
+        with open_data(xml_path) as xml_stream:
+            records = [ET.parse(xml_stream).getroot()]
+    else:
+        records = iter_xml_records(xml_path, union.record_path)
+    for record in records:
+        varid_vals, vs_texts = extract_xml_values(record, union)
+        yield tuple(build_rows_from_values(varid_vals, vs_texts, xml_plan) for xml_plan in xml_plans)
+
+
+def build_rows_from_record(xr, xml_plan):
+    """
+    Build a dict like csv.DictReader would, with keys for:
+    - ID/Control_ID/etc. (top-level)
+    - every val_source found in the mapping
+    Missing paths are included as empty strings to avoid KeyError in the compiled mapping.
+    """
+    varid_vals, vs_texts = extract_xml_values(xr, xml_plan)
+    return build_rows_from_values(varid_vals, vs_texts, xml_plan)
+
+
+def build_rows_from_values(varid_vals, vs_texts, xml_plan):
+    """Build the rows of a record from its extracted values (see build_rows_from_record())."""
+    # ensure all varids exist in row
+    row = XmlRow()
+    for vid in xml_plan.varids:
+        row[vid] = varid_vals.get(vid, "")
+
+    vs_values = {}
+    for vs in xml_plan.val_sources:
+        vals = vs_texts[vs]
+        # normalize + dedupe, preserving order
+        vals = [v.strip() for v in vals if v and v.strip()]
+        seen = set()
+        vals = [v for v in vals if not (v in seen or seen.add(v))]
+
+        row[vs] = vals[0] if vals else ""
+        if vs in xml_plan.foreach_sources:
+            # Repeated values are iterated by the mapping, not by cloning the row
+            row.multi[vs] = vals
+        else:
+            vs_values[vs] = vals
+
+    rows = [row]
+
+    # Helper script to return a tuple (rows) of all items sorted by key.
+    def row_sig(d):
+        return tuple(sorted(d.items()))
+
+    seen_rows = {row_sig(row)}
+
+    for vs, vals in vs_values.items():
+        if len(vals) > 1:
+            for extra_val in vals[1:]:
+                r = XmlRow(row)
+                r.multi = row.multi
+                r[vs] = extra_val
+                sig = row_sig(r)
+                if sig not in seen_rows:
+                    rows.append(r)
+                    seen_rows.add(sig)
+
+    return rows
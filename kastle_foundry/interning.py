@@ -0,0 +1,129 @@
+"""
+Interning the terms minted from rows: the URIs of instance nodes and the
+literals of datatype nodes.
+
+Categorical columns (a network code, a magnitude type, a status) repeat a
+few values over millions of rows, and each occurrence was quoted, checked
+and built into a new URIRef or Literal. A TermCache keeps the terms a node
+built most recently in an LRU of bounded size, keyed by what they are built
+from: the varid values of an instance URI pattern (nodes with the same
+pattern share a cache), or the lexical value of a datatype node (the
+datatype is the node's). A repeated value then costs one lookup, and rows
+share one term object instead of holding copies. The output is unchanged.
+
+A miss costs more than building the term directly, so a cache only pays off
+when values repeat. Each cache is probed on its first PROBE_LOOKUPS lookups
+and dropped for the rest of the run if fewer than MIN_HIT_RATE of them hit
+(a column of ids, or of measurements).
+
+URIRef() logs a warning for each URI it finds invalid. The URIs of a
+pattern are only built without it (trusted_uri()) when the pattern is
+clean, and a pattern that is not is not interned, so its warnings are the
+same with or without the caches: one per URI built.
+"""
+import logging
+from functools import lru_cache
+
+from rdflib import URIRef
+
+
+def rdflib_uri_check():
+    """
+    rdflib's check for the URIs URIRef() warns about, if it is there and
+    still tells a clean URI from one it warns about; None otherwise.
+    """
+    try:
+        # Private to rdflib
+        from rdflib.term import _is_valid_uri
+        if _is_valid_uri("http://example.org/a") and not _is_valid_uri("http://example.org/a b"):
+            return _is_valid_uri
+    except Exception:
+        pass
+    return None
+
+
+# Without it every URI goes through URIRef()
+_is_valid_uri = rdflib_uri_check()
+
+logger = logging.getLogger(__name__)
+
+# Terms kept per cache (--term-cache)
+CACHE_SIZE = 4096
+
+PROBE_LOOKUPS = 1000
+# Below this, the misses cost more than the hits save
+MIN_HIT_RATE = 0.3
+
+
+def trusted_uri(value):
+    """A URIRef for a string already known to pass URIRef's validity check."""
+    return str.__new__(URIRef, value)
+
+
+def uri_maker(prefix, suffix):
+    """
+    The URIRef constructor for URIs built from prefix, quoted varids and suffix:
+    quoted varids never hold characters URIRef warns about, so when the rest of
+    the pattern is clean the per-URI check can be skipped.
+    """
+    if _is_valid_uri is not None and _is_valid_uri(prefix + suffix):
+        return trusted_uri
+    return URIRef
+
+
+class TermCache:
+    """
+    An LRU of the terms make(key) built, with get(key) as the lookup. Once
+    dropped (or with size 0), get is make itself.
+    """
+    __slots__ = ("name", "make", "size", "get", "active", "probing", "hits", "misses", "taken")
+
+    def __init__(self, name, make, size=CACHE_SIZE):
+        self.name = name
+        self.make = make
+        self.size = size
+        self.active = size > 0
+        self.probing = self.active
+        self.get = lru_cache(size)(make) if self.active else make
+        # The lookups counted by the LRU before it was dropped
+        self.hits = 0
+        self.misses = 0
+        # The counts at the last take()
+        self.taken = (0, 0)
+
+    def __reduce__(self):
+        # The LRU is not pickled; a spawned worker starts with an empty one
+        return TermCache, (self.name, self.make, self.size)
+
+    def counts(self):
+        """(hits, misses) so far."""
+        if not self.active:
+            return self.hits, self.misses
+        info = self.get.cache_info()
+        return self.hits + info.hits, self.misses + info.misses
+
+    def check(self):
+        """Drop the LRU if its probe shows values do not repeat; return whether it is still probed."""
+        if not self.probing:
+            return False
+        hits, misses = self.get.cache_info()[:2]
+        if hits + misses < PROBE_LOOKUPS:
+            return True
+        self.probing = False
+        if hits < MIN_HIT_RATE * (hits + misses):
+            logger.debug(f"Term cache of {self.name}: {hits} hits in {hits + misses} lookups, not kept")
+            self.drop()
+        return False
+
+    def drop(self):
+        self.hits, self.misses = self.counts()
+        self.get.cache_clear()
+        self.get = self.make
+        self.active = False
+
+    def take(self):
+        """Return the (hits, misses) since the last take, e.g. to ship a worker's share to the parent."""
+        hits, misses = self.counts()
+        counts = (hits - self.taken[0], misses - self.taken[1])
+        self.taken = (hits, misses)
+        return counts
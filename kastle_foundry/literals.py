@@ -0,0 +1,178 @@
+"""
+Validating and canonicalizing literal values per datatype.
+
+Literal(value, datatype=...) looks the datatype up in rdflib's conversion
+tables, converts the value, checks it is well formed and converts it back
+to a normalized lexical form, for every value. For the common XSD datatypes
+a LiteralCodec does the same work with one precompiled parse and format
+step, and builds the Literal directly. The terms (lexical form, value and
+ill-typed flag) are the same as rdflib's, so the output does not change.
+
+The Literals of a node are interned (see interning.py): a value repeated
+across rows is parsed once, while its Literal stays in the node's cache.
+
+Values that do not parse are not logged one by one (rdflib logs a warning
+with a traceback for each); the codec counts them and keeps a few samples,
+and log_invalid_literals() reports them per column at the end of a run.
+"""
+import logging
+import re
+from datetime import date, datetime
+from decimal import Decimal
+
+from rdflib import XSD, Literal
+
+from .interning import TermCache
+
+logger = logging.getLogger(__name__)
+
+# Invalid values kept per column, for the report
+MAX_SAMPLES = 5
+
+
+class Fallback(Exception):
+    """Raised by a parser for values it leaves to rdflib's generic conversion."""
+
+
+def parse_boolean(lexical):
+    if lexical == "true" or lexical == "1":
+        return True
+    if lexical == "false" or lexical == "0":
+        return False
+    # rdflib maps other spellings to a value but flags them as ill-typed
+    raise Fallback()
+
+
+date_pattern = re.compile(r"\d{4}-\d\d-\d\d")
+
+
+def parse_date(lexical):
+    # Dates with a time zone or a sign are left to rdflib's own parser
+    if not date_pattern.fullmatch(lexical):
+        raise Fallback()
+    return date.fromisoformat(lexical)
+
+
+# datatype: (lexical form -> value, value -> canonical lexical form), matching
+# rdflib's lexical-to-value conversion and its normalization of the value
+CODECS = {
+    XSD.double: (float, str),
+    XSD.integer: (int, str),
+    XSD.decimal: (Decimal, "{:f}".format),
+    XSD.boolean: (parse_boolean, lambda value: "true" if value else "false"),
+    XSD.dateTime: (datetime.fromisoformat, datetime.isoformat),
+    XSD.date: (parse_date, date.isoformat),
+}
+
+
+def make_literal(lexical, datatype, value, ill_typed=False):
+    """A Literal with the given parts, without rdflib's conversion."""
+    literal = str.__new__(Literal, lexical)
+    literal._language = None
+    literal._datatype = datatype
+    literal._value = value
+    literal._ill_typed = ill_typed
+    return literal
+
+
+class LiteralCodec:
+    """
+    Encodes the values of one datatype node as Literals, counting the values
+    that are not valid for the datatype.
+    """
+    __slots__ = ("datatype", "parse", "canonical", "invalid", "samples", "terms")
+
+    def __init__(self, datatype, name=None):
+        self.datatype = datatype
+        self.parse, self.canonical = CODECS.get(datatype, (None, None))
+        self.invalid = 0
+        self.samples = []
+        # Literals by lexical value; a cached Literal is still counted if it is ill-typed
+        self.terms = TermCache(name or str(datatype), self.build)
+
+    def encode(self, lexical):
+        """Return the Literal for one non-empty value."""
+        literal = self.terms.get(lexical)
+        if literal._ill_typed:
+            self.record(lexical)
+        return literal
+
+    def build(self, lexical):
+        if self.parse is None or not isinstance(lexical, str):
+            return Literal(lexical, datatype=self.datatype)
+        try:
+            value = self.parse(lexical)
+        except Fallback:
+            return Literal(lexical, datatype=self.datatype)
+        except Exception:
+            # What rdflib returns for a value it cannot convert: the lexical
+            # form as given, with no value
+            return make_literal(lexical, self.datatype, None, True)
+        return make_literal(self.canonical(value), self.datatype, value)
+
+    def encode_column(self, values):
+        """Return the Literal for each value of a column, or None where it is empty."""
+        if self.terms.active:
+            get = self.terms.get
+            literals = [get(v) if v else None for v in values]
+            for lexical, literal in zip(values, literals):
+                if literal is not None and literal._ill_typed:
+                    self.record(lexical)
+            return literals
+        if self.parse is None:
+            return [self.encode(v) if v else None for v in values]
+        parse, canonical, datatype = self.parse, self.canonical, self.datatype
+        new = str.__new__
+        literals = []
+        append = literals.append
+        for lexical in values:
+            if not lexical:
+                append(None)
+                continue
+            try:
+                value = parse(lexical)
+            except Fallback:
+                append(self.encode(lexical))
+                continue
+            except Exception:
+                self.record(lexical)
+                append(make_literal(lexical, datatype, None, True))
+                continue
+            literal = new(Literal, canonical(value))
+            literal._language = None
+            literal._datatype = datatype
+            literal._value = value
+            literal._ill_typed = False
+            append(literal)
+        return literals
+
+    def record(self, lexical):
+        self.invalid += 1
+        if len(self.samples) < MAX_SAMPLES and lexical not in self.samples:
+            self.samples.append(lexical)
+
+    def take(self):
+        """Return and reset the invalid values seen, to ship a worker's share to the parent."""
+        counts = (self.invalid, self.samples)
+        self.invalid = 0
+        self.samples = []
+        return counts
+
+    def merge(self, counts):
+        invalid, samples = counts
+        self.invalid += invalid
+        for lexical in samples:
+            if len(self.samples) < MAX_SAMPLES and lexical not in self.samples:
+                self.samples.append(lexical)
+
+
+def log_invalid_literals(nodes):
+    """Log one warning per datatype node that met values invalid for its datatype."""
+    for node in nodes:
+        codec = getattr(node, "codec", None)
+        if codec is None or not codec.invalid:
+            continue
+        sources = ", ".join(node.sources)
+        samples = ", ".join(repr(s) for s in codec.samples)
+        logger.warning(f"{codec.invalid} value(s) of '{sources}' are not valid {codec.datatype} "
+                       f"({node.path}), e.g. {samples}")
@@ -0,0 +1,324 @@
+"""
+Lookup tables: joining input rows to secondary CSV tables (the mapping's
+lookups: section).
+
+    lookups:
+      agency:
+        file: "networks.csv"  # relative to the mapping file
+        key: "code"           # the table's key column(s)
+        match: "net"          # the input column(s) holding the key (default: the key column names)
+        index: "memory"       # or "disk"
+
+A val_source, varid or foreach source written "<lookup>.<column>" (e.g.
+"agency.name") reads that column of the table row whose key matches the
+input row. Each table is read once, when the mapping is compiled, keeping
+only the columns the mapping references, into a hash index: a dict, or
+for tables too large for memory ("disk"), an open-addressing hash table in
+memory-mapped temporary files. Either way a probe costs O(1).
+
+Rows are joined just before they are transformed: the referenced lookup
+columns are added to the row (or, in the columnar engine, to the column
+batch), so the rest of the plan reads them like any other column. Keys are
+compared with surrounding whitespace stripped, and a row without a match
+reads "" for every column of the lookup. Lookups are joined in the order
+they are declared, so a lookup's "match" may name a column of an earlier one.
+"""
+import array
+import csv
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from .compression import open_data
+from .mapping import collect_varids, iter_foreach_sources, iter_val_sources, mapping_root
+
+logger = logging.getLogger(__name__)
+
+INDEX_KINDS = ("memory", "disk")
+
+
+def lookup_error(msg):
+    logger.error(msg)
+    raise Exception(msg)
+
+
+def as_list(value):
+    return list(value) if isinstance(value, list) else [value]
+
+
+# ----------------------------------------------------------------
+# Indexes
+# ----------------------------------------------------------------
+
+class MemoryIndex:
+    """{key tuple: column values}; the first row with a key wins."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def add(self, key, values):
+        """Add a row; return False if its key was already there."""
+        if key in self.entries:
+            return False
+        self.entries[key] = values
+        return True
+
+    def finish(self):
+        """Return the number of rows dropped for repeating a key (all counted by add() here)."""
+        return 0
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DiskIndex:
+    """
+    An open-addressing hash table on disk: the rows go to a data file as
+    (key length, value length, key, value) records, and a slot file holds
+    the offset (+ 1) of the record hashed to each slot, probed linearly.
+    Both files are temporary and read through mmap.
+    """
+    RECORD = struct.Struct("<II")
+
+    def __init__(self):
+        self.data = tempfile.TemporaryFile(prefix="foundry-lookup-")
+        self.size = 0
+        self.hashes = array.array("L")
+        self.offsets = array.array("Q")
+        self.count = 0
+
+    @staticmethod
+    def encode_key(key):
+        return json.dumps(key).encode("ascii")
+
+    def add(self, key, values):
+        key = self.encode_key(key)
+        value = json.dumps(values).encode("ascii")
+        self.hashes.append(zlib.crc32(key))
+        self.offsets.append(self.size)
+        record = self.RECORD.pack(len(key), len(value)) + key + value
+        self.data.write(record)
+        self.size += len(record)
+        return True
+
+    def finish(self):
+        """Build the slot table once every row has been added; return the rows dropped for repeating a key."""
+        self.data.flush()
+        # At most half the slots are used, so probe sequences stay short
+        slots = 8
+        while slots < 2 * len(self.offsets):
+            slots *= 2
+        self.mask = slots - 1
+        self.view = mmap.mmap(self.data.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.slot_file = tempfile.TemporaryFile(prefix="foundry-lookup-")
+        self.slot_file.truncate(slots * 8)
+        self.slot_map = mmap.mmap(self.slot_file.fileno(), slots * 8)
+        self.slots = memoryview(self.slot_map).cast("Q")
+        duplicates = 0
+        for h, offset in zip(self.hashes, self.offsets):
+            if self.find(h & self.mask, self.record_key(offset)) is not None:
+                duplicates += 1
+                continue
+            slot = h & self.mask
+            while self.slots[slot]:
+                slot = (slot + 1) & self.mask
+            self.slots[slot] = offset + 1
+            self.count += 1
+        self.hashes = self.offsets = None
+        return duplicates
+
+    def record_key(self, offset):
+        key_length, _ = self.RECORD.unpack_from(self.view, offset)
+        start = offset + self.RECORD.size
+        return self.view[start:start + key_length]
+
+    def find(self, slot, key):
+        """The offset of the record with key, probing from slot; None if absent."""
+        while True:
+            entry = self.slots[slot]
+            if not entry:
+                return None
+            if self.record_key(entry - 1) == key:
+                return entry - 1
+            slot = (slot + 1) & self.mask
+
+    def get(self, key):
+        key = self.encode_key(key)
+        offset = self.find(zlib.crc32(key) & self.mask, key)
+        if offset is None:
+            return None
+        key_length, value_length = self.RECORD.unpack_from(self.view, offset)
+        start = offset + self.RECORD.size + key_length
+        return tuple(json.loads(self.view[start:start + value_length]))
+
+    def __len__(self):
+        return self.count
+
+
+# ----------------------------------------------------------------
+# Tables
+# ----------------------------------------------------------------
+
+class LookupTable:
+    """One lookup: a CSV table indexed by its key columns, holding the columns the mapping references."""
+
+    def __init__(self, name, spec, columns):
+        self.name = name
+        self.spec = spec
+        if not isinstance(spec, dict) or "file" not in spec or "key" not in spec:
+            lookup_error(f"Lookup '{name}' needs a 'file' and a 'key'")
+        self.path = spec["file"]
+        self.key = as_list(spec["key"])
+        self.match = as_list(spec.get("match", spec["key"]))
+        if len(self.match) != len(self.key):
+            lookup_error(f"Lookup '{name}' has {len(self.key)} key column(s) but {len(self.match)} 'match' column(s)")
+        self.index_kind = spec.get("index", "memory")
+        if self.index_kind not in INDEX_KINDS:
+            lookup_error(f"Lookup '{name}' has an unknown index '{self.index_kind}' (use memory or disk)")
+        self.columns = columns
+        # The names the mapping reads the columns under
+        self.sources = [f"{name}.{column}" for column in columns]
+        self.empty = ("",) * len(columns)
+        if not os.path.isfile(self.path):
+            lookup_error(f"Lookup '{name}' file not found: {self.path}")
+        stat = os.stat(self.path)
+        self.version = (stat.st_mtime_ns, stat.st_size)
+        self.index = self.load()
+
+    def __reduce__(self):
+        # Indexes are rebuilt, rather than pickled, for spawned workers
+        return LookupTable, (self.name, self.spec, self.columns)
+
+    def load(self):
+        index = DiskIndex() if self.index_kind == "disk" else MemoryIndex()
+        duplicates = 0
+        with open_data(self.path, "r", encoding="utf-8-sig", newline="") as stream:
+            reader = csv.reader(stream)
+            header = next(reader, None) or []
+            positions = {name: i for i, name in enumerate(header)}
+            for column in self.key + self.columns:
+                if column not in positions:
+                    lookup_error(f"Lookup '{self.name}' has no column '{column}' in: {self.path}")
+            key_positions = [positions[column] for column in self.key]
+            value_positions = [positions[column] for column in self.columns]
+            width = len(header)
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) < width:
+                    row = row + [""] * (width - len(row))
+                key = tuple(row[i].strip() for i in key_positions)
+                if not index.add(key, tuple(row[i] for i in value_positions)):
+                    duplicates += 1
+        duplicates += index.finish()
+        if duplicates:
+            logger.warning(f"Lookup '{self.name}': {duplicates} row(s) repeat a key and are ignored "
+                           f"(the first row with a key wins): {self.path}")
+        logger.info(f"Lookup '{self.name}': {len(index)} keys from {self.path}")
+        return index
+
+    def join_row(self, row):
+        key = []
+        for source in self.match:
+            value = row.get(source)
+            if value is None:
+                if source not in row:
+                    lookup_error(f"Lookup '{self.name}' key column '{source}' missing from data file")
+                value = ""
+            key.append(value.strip())
+        values = self.index.get(tuple(key)) or self.empty
+        for source, value in zip(self.sources, values):
+            row[source] = value
+
+    def join_columns(self, columns, n):
+        key_columns = []
+        for source in self.match:
+            column = columns.get(source)
+            if column is None:
+                lookup_error(f"Lookup '{self.name}' key column '{source}' missing from data file")
+            key_columns.append([v.strip() if v else "" for v in column])
+        # Keys repeat within a batch (e.g. a network code), so each is probed once
+        get = self.index.get
+        found = {}
+        matches = []
+        for key in zip(*key_columns):
+            values = found.get(key)
+            if values is None:
+                values = found[key] = get(key) or self.empty
+            matches.append(values)
+        for i, source in enumerate(self.sources):
+            columns[source] = [values[i] for values in matches]
+
+
+class Lookups:
+    """The lookup tables of a mapping, joined to rows in declaration order."""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.sources = {source for table in tables for source in table.sources}
+        # The input columns (or XML paths) the keys are read from
+        self.key_sources = list(dict.fromkeys(source for table in tables for source in table.match
+                                              if source not in self.sources))
+
+    def input_sources(self, sources):
+        """The input columns to read for sources: lookup columns are replaced by the keys."""
+        return list(dict.fromkeys([source for source in sources if source not in self.sources] + self.key_sources))
+
+    def join_row(self, row):
+        for table in self.tables:
+            table.join_row(row)
+
+    def join_batch(self, batch):
+        """Return a ColumnBatch with the lookup columns added (batch itself is left as it is)."""
+        from .columnar import ColumnBatch
+        columns = dict(batch.columns)
+        for table in self.tables:
+            table.join_columns(columns, batch.size)
+        return ColumnBatch(columns, batch.size)
+
+    def versions(self):
+        """[name, path, mtime, size] per table, for telling whether a table changed between runs."""
+        return [[table.name, table.path, *table.version] for table in self.tables]
+
+    def changed(self):
+        """Whether any table file changed since it was loaded."""
+        for table in self.tables:
+            stat = os.stat(table.path)
+            if (stat.st_mtime_ns, stat.st_size) != table.version:
+                return True
+        return False
+
+
+def compile_lookups(mapping):
+    """Load the mapping's lookup tables; None if it has none."""
+    specs = mapping.get("lookups")
+    if not specs:
+        return None
+    if not isinstance(specs, dict):
+        lookup_error("'lookups' must map lookup names to their tables")
+    # The columns each lookup must hold: those named by the mapping, or by
+    # the "match" of a later lookup
+    root = mapping_root(mapping)
+    sources = set(iter_val_sources(root)) | collect_varids(root) | set(iter_foreach_sources(root))
+    for spec in specs.values():
+        if isinstance(spec, dict):
+            sources.update(as_list(spec.get("match", spec.get("key", []))))
+    referenced = {}
+    for source in sorted(source for source in sources if isinstance(source, str)):
+        name, _, column = source.partition(".")
+        if column and name in specs:
+            referenced.setdefault(name, []).append(column)
+    tables = []
+    for name, spec in specs.items():
+        if name not in referenced:
+            logger.info(f"Lookup '{name}' is not used by the mapping, so it is not loaded.")
+            continue
+        tables.append(LookupTable(name, spec, referenced[name]))
+    return Lookups(tables) if tables else None
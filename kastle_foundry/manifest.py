@@ -0,0 +1,73 @@
+"""The run manifest, used to skip unchanged inputs and resume partial ones."""
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# The output directory holds a manifest with a content hash per input file,
+# the mapping hash and the output settings, and the last committed row of
+# each input. A rerun skips unchanged inputs and resumes partial ones.
+
+MANIFEST_FILE = "foundry-manifest.json"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """Checkpoint record of a run, kept in <output_dir>/foundry-manifest.json."""
+
+    # Saves are rate-limited; a manifest that lags behind the output is still safe
+    SAVE_INTERVAL = 2.0
+
+    def __init__(self, path, settings, resume=True):
+        self.path = path
+        self.settings = settings
+        self.files = {}
+        self.last_save = 0.0
+        if resume and os.path.exists(path):
+            with open(path, "r") as stream:
+                previous = json.load(stream)
+            if previous.get("settings") == settings:
+                self.files = previous.get("files", {})
+            else:
+                logger.warning("Mapping or output settings changed since the last run, processing every input again.")
+
+    def begin(self, data_path):
+        """Return the entry for an input file, reset if its content changed."""
+        key = os.path.abspath(data_path)
+        content_hash = file_sha256(data_path)
+        entry = self.files.get(key)
+        if entry is None or entry["hash"] != content_hash:
+            entry = {"hash": content_hash, "rows": 0, "state": {}, "complete": False}
+            self.files[key] = entry
+        return entry
+
+    def checkpoint(self, entry, rows, state):
+        entry["rows"] = rows
+        entry["state"] = state
+        self.save()
+
+    def complete(self, entry, rows):
+        entry["rows"] = rows
+        entry["state"] = {}
+        entry["complete"] = True
+        self.save()
+
+    def save(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_save < self.SAVE_INTERVAL:
+            return
+        self.last_save = now
+        part_path = self.path + ".part"
+        with open(part_path, "w") as stream:
+            json.dump({"settings": self.settings, "files": self.files}, stream, indent=1)
+        os.replace(part_path, self.path)
@@ -0,0 +1,121 @@
+"""Loading mapping files, and helpers for walking and reporting on mapping nodes."""
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Indent for the details printed under a log message
+indent = "\t" * 9
+
+
+def load_mapping(mapping_path):
+    """Load a YAML mapping file and return it as a dict."""
+    # yaml is only needed here, so it is not imported with the package
+    try:
+        from yaml import load, CLoader as Loader
+    except ImportError:
+        from yaml import load, Loader
+
+    # Open the mapping file
+    logger.info(f"Opening: {mapping_path}")
+    mapping = None
+    with open(mapping_path, "r") as mapping_stream:
+        logger.info("Open success.")
+        mapping = load(mapping_stream, Loader=Loader)
+        logger.info("Load success.")
+    # Catch any loading problems that the parser didn't catch
+    if mapping is None:
+        raise Exception("Mapping not properly loaded.")
+    # Lookup tables are found relative to the mapping file
+    lookups = mapping.get("lookups") if isinstance(mapping, dict) else None
+    if isinstance(lookups, dict):
+        mapping_dir = os.path.dirname(os.path.abspath(mapping_path))
+        for spec in lookups.values():
+            if isinstance(spec, dict) and isinstance(spec.get("file"), str):
+                spec["file"] = os.path.join(mapping_dir, spec["file"])
+    return mapping
+
+
+def mapping_root(mapping):
+    """Get the root mapping (i.e., what will be recursively applied to the data)."""
+    try:
+        return mapping["root"]
+    except KeyError:
+        msg = "Missing root in mapping file, which is required"
+        logger.error(msg)
+        raise Exception(msg)
+
+
+def mapping_hash(mapping):
+    """A content hash of the mapping, for telling whether it changed between runs."""
+    canonical = json.dumps(mapping, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def log_message_with_node(msg, mapping, error_type="info"):
+    if error_type == "error":
+        level = logging.ERROR
+    elif error_type == "warning":
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+    # The node is only copied and formatted if the message will be emitted
+    if not logger.isEnabledFor(level):
+        return
+    mapping_copy = mapping.copy()
+    mapping_copy.pop('connections', None)
+    logger.log(level, f"{msg}: \n{indent}{mapping_copy}")
+
+
+def mapping_error(msg, mapping):
+    log_message_with_node(msg, mapping, error_type="error")
+    raise Exception(msg)
+
+
+def iter_val_sources(mapping_node):
+    """Yield every val_source used anywhere in the mapping."""
+    if isinstance(mapping_node, dict):
+        if "val_source" in mapping_node:
+            val_source = mapping_node["val_source"]
+            if isinstance(val_source, list):
+                for source in val_source:
+                    yield source
+            else:
+                yield val_source
+        # datatype nodes also live under "o"
+        for k, v in mapping_node.items():
+            if isinstance(v, (dict, list)):
+                yield from iter_val_sources(v)
+    elif isinstance(mapping_node, list):
+        for item in mapping_node:
+            yield from iter_val_sources(item)
+
+
+def iter_foreach_sources(mapping_node):
+    """Yield every foreach source used anywhere in the mapping."""
+    if isinstance(mapping_node, dict):
+        if "foreach" in mapping_node:
+            yield mapping_node["foreach"]
+        for v in mapping_node.values():
+            if isinstance(v, (dict, list)):
+                yield from iter_foreach_sources(v)
+    elif isinstance(mapping_node, list):
+        for item in mapping_node:
+            yield from iter_foreach_sources(item)
+
+
+def collect_varids(mapping_node):
+    """Return the set of every varid used anywhere in the mapping."""
+    ids = set()
+    if isinstance(mapping_node, dict):
+        if "varids" in mapping_node:
+            ids.update(mapping_node["varids"])
+        for v in mapping_node.values():
+            if isinstance(v, (dict, list)):
+                ids.update(collect_varids(v))
+    elif isinstance(mapping_node, list):
+        for item in mapping_node:
+            ids.update(collect_varids(item))
+    return ids
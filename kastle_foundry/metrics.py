@@ -0,0 +1,220 @@
+"""Run metrics and profiling (--metrics-out, --profile)."""
+import os
+import pstats
+import sys
+import time
+
+from .plan import NodeStats, iter_plan_nodes, iter_term_caches
+
+# With --metrics-out or --profile, every stage of the row loop is timed
+# (wall and CPU), along with rows/s and triples/s per input file, per-node
+# counters, term cache hit rates and peak RSS. Without them, stages are
+# called through untimed(), which only forwards the call, so the overhead
+# is close to zero. A stage's
+# CPU time is that of the thread it runs on: with a pipeline (see
+# pipeline.py), stages overlap, and their wall times add up to more than
+# the run's.
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# For ttl, serialization happens in "write"; for the streaming formats, in "encode"
+STAGES = ("read", "transform", "dedup", "encode", "write")
+
+
+def untimed(stage, func, *args):
+    return func(*args)
+
+
+class FileMetrics:
+    """Rows, triples and elapsed time for one input file."""
+    __slots__ = ("path", "rows", "triples", "wall", "cpu")
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.triples = 0
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+
+class RunMetrics:
+    """Stage timings, per-file rates and per-node counters for one run."""
+
+    def __init__(self, plan):
+        """plan is a compiled plan root, or a list of them (CompiledMapping.roots)."""
+        self.wall = dict.fromkeys(STAGES, 0.0)
+        self.cpu = dict.fromkeys(STAGES, 0.0)
+        self.files = []
+        self.started = (time.perf_counter(), time.process_time())
+        plans = plan if isinstance(plan, list) else [plan]
+        self.nodes = [node for root in plans for node in iter_plan_nodes(root)]
+        for node in self.nodes:
+            node.stats = NodeStats()
+        self.term_caches = [terms for root in plans for terms in iter_term_caches(root)]
+        # [hits, misses, whether every worker kept the cache], counted from
+        # here: a compiled mapping may be reused across runs
+        self.term_counts = [[0, 0, True] for _ in self.term_caches]
+        for terms in self.term_caches:
+            terms.take()
+
+    def detach(self):
+        """Stop counting on the plan's nodes."""
+        for node in self.nodes:
+            node.stats = None
+
+    def timed(self, stage, func, *args):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        result = func(*args)
+        self.wall[stage] += time.perf_counter() - wall
+        self.cpu[stage] += time.thread_time() - cpu
+        return result
+
+    def timed_iter(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            item = next(iterator, iterable)
+            self.wall[stage] += time.perf_counter() - wall
+            self.cpu[stage] += time.thread_time() - cpu
+            if item is iterable:
+                return
+            yield item
+
+    def reset(self):
+        self.wall = dict.fromkeys(STAGES, 0.0)
+        self.cpu = dict.fromkeys(STAGES, 0.0)
+        for node in self.nodes:
+            node.stats = NodeStats()
+        for terms in self.term_caches:
+            terms.take()
+
+    def snapshot(self):
+        """Return and reset the counters, to ship a worker's share to the parent."""
+        snap = (self.wall, self.cpu,
+                [(n.stats.applied, n.stats.triples, n.stats.skipped, n.stats.warnings)
+                 for n in self.nodes],
+                [terms.take() + (terms.active,) for terms in self.term_caches])
+        self.reset()
+        return snap
+
+    def merge(self, snap):
+        wall, cpu, node_counts, term_counts = snap
+        for stage in STAGES:
+            self.wall[stage] += wall[stage]
+            self.cpu[stage] += cpu[stage]
+        for node, (applied, triples, skipped, warnings) in zip(self.nodes, node_counts):
+            node.stats.applied += applied
+            node.stats.triples += triples
+            node.stats.skipped += skipped
+            node.stats.warnings += warnings
+        for counts, (hits, misses, kept) in zip(self.term_counts, term_counts):
+            counts[0] += hits
+            counts[1] += misses
+            counts[2] = counts[2] and kept
+
+    def file_done(self, file_metrics):
+        wall = time.perf_counter() - file_metrics.wall
+        self.files.append({
+            "path": file_metrics.path,
+            "rows": file_metrics.rows,
+            "triples": file_metrics.triples,
+            "wall_s": wall,
+            "cpu_s": time.process_time() - file_metrics.cpu,
+            "rows_per_s": file_metrics.rows / wall if wall else None,
+            "triples_per_s": file_metrics.triples / wall if wall else None,
+        })
+
+    def report(self, profiler=None):
+        wall = time.perf_counter() - self.started[0]
+        rows = sum(f["rows"] for f in self.files)
+        triples = sum(f["triples"] for f in self.files)
+        report = {
+            "wall_s": wall,
+            "cpu_s": time.process_time() - self.started[1],
+            "rows": rows,
+            "triples": triples,
+            "rows_per_s": rows / wall if wall else None,
+            "triples_per_s": triples / wall if wall else None,
+            "peak_rss_bytes": peak_rss(),
+            "stages": {stage: {"wall_s": self.wall[stage], "cpu_s": self.cpu[stage]}
+                       for stage in STAGES},
+            "files": self.files,
+            "nodes": [node_report(n) for n in self.nodes],
+            "term_caches": [term_cache_report(terms, counts)
+                            for terms, counts in zip(self.term_caches, self.term_counts)],
+        }
+        if profiler is not None:
+            report["hot_functions"] = hot_functions(profiler)
+        return report
+
+
+def node_report(node):
+    report = {"path": node.path, "kind": node.kind, "applied": node.stats.applied,
+              "triples": node.stats.triples, "skipped": node.stats.skipped,
+              "warnings": node.stats.warnings}
+    codec = getattr(node, "codec", None)
+    if codec is not None:
+        # Values that are not valid for the node's datatype
+        report["invalid"] = codec.invalid
+        report["invalid_samples"] = list(codec.samples)
+    return report
+
+
+def term_cache_report(terms, counts):
+    """Lookups of a TermCache in this run: its own, and those of the workers in counts."""
+    hits, misses = terms.take()
+    counts[0] += hits
+    counts[1] += misses
+    hits, misses, kept = counts
+    return {"node": terms.name, "hits": hits, "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None, "kept": kept and terms.active}
+
+
+def peak_rss():
+    """Peak resident set size in bytes, for this process and its (waited-for) workers."""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+def hot_functions(profiler, limit=25):
+    """The functions with the most time spent in their own body."""
+    hot = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in pstats.Stats(profiler).stats.items():
+        hot.append({"function": f"{os.path.basename(filename)}:{line}({name})",
+                    "calls": ncalls, "tottime_s": tottime, "cumtime_s": cumtime})
+    hot.sort(key=lambda f: f["tottime_s"], reverse=True)
+    return hot[:limit]
+
+
+def print_metrics_summary(report):
+    out = sys.stderr
+    out.write(f"\nRun: {report['rows']} rows, {report['triples']} triples in {report['wall_s']:.2f}s wall, "
+              f"{report['cpu_s']:.2f}s CPU\n")
+    out.write(f"{'stage':<12}{'wall s':>10}{'cpu s':>10}\n")
+    for stage, t in report["stages"].items():
+        out.write(f"{stage:<12}{t['wall_s']:>10.3f}{t['cpu_s']:>10.3f}\n")
+    for f in report["files"]:
+        out.write(f"{f['path']}: {f['rows']} rows ({f['rows_per_s'] or 0:.0f}/s), "
+                  f"{f['triples']} triples ({f['triples_per_s'] or 0:.0f}/s)\n")
+    for n in report["nodes"]:
+        if n["skipped"] or n["warnings"] or n.get("invalid"):
+            out.write(f"{n['path']}: {n['skipped']} skipped, {n['warnings']} warnings, "
+                      f"{n.get('invalid', 0)} invalid\n")
+    for t in report["term_caches"]:
+        if t["hit_rate"] is not None:
+            out.write(f"{t['node']}: term cache {t['hit_rate']:.1%} hits of {t['hits'] + t['misses']}"
+                      f"{'' if t['kept'] else ' (not kept)'}\n")
+    rss = report["peak_rss_bytes"]
+    if rss is not None:
+        out.write(f"Peak RSS: {rss['self'] / 2**20:.1f} MB (workers: {rss['workers'] / 2**20:.1f} MB)\n")
+    for f in report.get("hot_functions", [])[:15]:
+        out.write(f"{f['tottime_s']:>9.3f}s {f['calls']:>10} {f['function']}\n")
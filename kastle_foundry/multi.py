@@ -0,0 +1,234 @@
+"""
+Applying several mappings to the same input in one read pass (-m given more than once).
+
+Each input file is read and parsed once for all the mappings. CSV rows are
+shared by every mapping (a mapping with lookups joins its tables to copies
+of them); in the columnar engine, the column batches hold the union of the
+columns the mappings read. Each XML record is walked once
+for the union of the mappings' varids and val_sources, and every mapping
+then builds its own rows from the extracted values.
+
+The triples of each row are either merged into one output stream (in
+mapping order), or kept apart: each mapping then writes to its own
+subdirectory of the output directory, named after the mapping file, with
+the same files a run of that mapping alone would write for CSV input. One
+run manifest in the output directory covers them all.
+
+With XML input, a record counts as one row of the output, however many
+rows a mapping builds from it: the row layout numbers files by record, and
+a triple repeated across a record's rows is written once.
+"""
+import copy
+import itertools
+import logging
+import os
+
+from .inputs import build_record_rows_from_xml, is_xml, iter_batches, iter_rows
+from .plan import RowTriples
+
+logger = logging.getLogger(__name__)
+
+
+def mapping_names(mapping_paths):
+    """The name of each mapping (its file name without the extension), as used for separate outputs."""
+    return [os.path.splitext(os.path.basename(path))[0] for path in mapping_paths]
+
+
+def chain_rows(rows):
+    """The triples of several rows as one, keyed by the subject of the first."""
+    return RowTriples(itertools.chain.from_iterable(rows), rows[0].subject if rows else None)
+
+
+class RecordBatch(list):
+    """A batch of XML records, each a tuple with the rows built for every mapping."""
+
+
+class MultiMapping:
+    """
+    Compiled mappings applied together to the same rows. With merged, a
+    row's triples are those of every mapping, one after the other;
+    otherwise they are a tuple with one list per mapping, to be written by a
+    MultiLayout. Stands in for a CompiledMapping in run().
+    """
+
+    def __init__(self, compiled, names, merged=False):
+        self.compiled = compiled
+        self.names = names
+        self.merged = merged
+        self.mapping = [c.mapping for c in compiled]
+        self.prefixes = compiled[0].prefixes
+        self.roots = [c.root for c in compiled]
+        if merged:
+            self.cvs = [cv for c in compiled for cv in c.cvs]
+        else:
+            self.cvs = [c.cvs for c in compiled]
+
+    def read_batches(self, data_path, start=0, batch_size=1000, engine="auto"):
+        """Yield the rows of a file in batches for every mapping (see CompiledMapping.read_batches())."""
+        if is_xml(data_path):
+            records = build_record_rows_from_xml(data_path, [c.xml_plan for c in self.compiled])
+            if start:
+                records = itertools.islice(records, start, None)
+            return (RecordBatch(batch) for batch in iter_batches(records, batch_size))
+        if engine != "row":
+            from .columnar import iter_csv_batches
+            batch_plans = [c.get_batch_plan() for c in self.compiled]
+            if all(batch_plan is not None for batch_plan in batch_plans):
+                columns = dict.fromkeys(name for c in self.compiled for name in c.input_columns())
+                return iter_csv_batches(data_path, list(columns), start, batch_size)
+            if engine == "columnar":
+                logger.info("A mapping uses foreach, so rows are processed one at a time.")
+        # CSV rows hold every column, so one row serves every mapping
+        rows = iter_rows(data_path, None)
+        if start:
+            rows = itertools.islice(rows, start, None)
+        return iter_batches(rows, batch_size)
+
+    def transform_batch(self, batch):
+        """Return the triples of every row of a batch from read_batches(), one entry per row."""
+        if isinstance(batch, RecordBatch):
+            parts = [[chain_rows([c.transform_row(row) for row in record[i]]) for record in batch]
+                     for i, c in enumerate(self.compiled)]
+            for c in self.compiled:
+                c.check_term_caches()
+        elif isinstance(batch, list):
+            # CSV rows are shared, and joining lookups adds their columns to the
+            # row itself: a mapping with lookups joins copies of its own
+            parts = [c.transform_batch([dict(row) for row in batch] if c.lookups is not None else batch)
+                     for c in self.compiled]
+        else:
+            parts = [c.transform_batch(batch) for c in self.compiled]
+        if self.merged:
+            return [chain_rows(row) for row in zip(*parts)]
+        return list(zip(*parts))
+
+    def lookup_versions(self):
+        return [version for c in self.compiled for version in c.lookup_versions()]
+
+    def take_invalid_literals(self):
+        return [c.take_invalid_literals() for c in self.compiled]
+
+    def merge_invalid_literals(self, counts):
+        for c, mapping_counts in zip(self.compiled, counts):
+            c.merge_invalid_literals(mapping_counts)
+
+    def log_invalid_literals(self):
+        for c in self.compiled:
+            c.log_invalid_literals()
+
+    def take_diagnostics(self):
+        return [c.take_diagnostics() for c in self.compiled]
+
+    def merge_diagnostics(self, issues):
+        for c, mapping_issues in zip(self.compiled, issues):
+            c.merge_diagnostics(mapping_issues)
+
+    def log_diagnostics(self):
+        for c, name in zip(self.compiled, self.names):
+            c.diagnostics.log(name)
+
+    def diagnostics_report(self):
+        return [{"mapping": name, **issue} for c, name in zip(self.compiled, self.names)
+                for issue in c.diagnostics_report()]
+
+
+# ----------------------------------------------------------------
+# Separate outputs
+# ----------------------------------------------------------------
+
+class MultiOutput:
+    """The OutputSettings of each mapping: settings, applied to <output_dir>/<name>."""
+
+    def __init__(self, settings, names):
+        self.settings = settings
+        self.names = names
+        self.output_dir = settings.output_dir
+        self.prefixes = settings.prefixes
+        self.layout = settings.layout
+        self.outputs = []
+        for name in names:
+            output = copy.copy(settings)
+            output.output_dir = os.path.join(settings.output_dir, name)
+            self.outputs.append(output)
+
+    def open_layout(self, base):
+        return MultiLayout(base, self.outputs)
+
+    def describe(self):
+        return {**self.settings.describe(), "outputs": self.names}
+
+
+class MultiLayout:
+    """
+    A layout per mapping (see OutputSettings.open_layout()), used like one:
+    row triples and fragments are tuples with one entry per mapping. After
+    a resume, each layout only writes the rows past its own checkpoint.
+    """
+
+    def __init__(self, base, outputs):
+        for output in outputs:
+            os.makedirs(output.output_dir, exist_ok=True)
+        self.layouts = [output.open_layout(base) for output in outputs]
+        self.layout = outputs[0].layout
+        # The first row each layout still has to write
+        self.starts = [0] * len(self.layouts)
+
+    @property
+    def rows(self):
+        return min(layout.rows for layout in self.layouts)
+
+    def resume(self, rows, state):
+        parts = state.get("parts")
+        if rows == 0 or parts is None or len(parts) != len(self.layouts):
+            return 0
+        self.starts = [layout.resume(*part) for layout, part in zip(self.layouts, parts)]
+        return min(self.starts)
+
+    def encode(self, triples):
+        return tuple(layout.encode(part) for layout, part in zip(self.layouts, triples))
+
+    def row_triples(self, triples):
+        return sum(len(part) for part in triples)
+
+    def fragment_triples(self, fragment):
+        return sum(layout.fragment_triples(part) for layout, part in zip(self.layouts, fragment))
+
+    def write_cvs(self, cv_plans, dedup=None):
+        for i, layout in enumerate(self.layouts):
+            if self.starts[i] == 0:
+                layout.write_cvs(cv_plans[i], dedup.dedups[i] if dedup is not None else None)
+
+    def write_row(self, j, fragment):
+        for layout, start, part in zip(self.layouts, self.starts, fragment):
+            if j >= start:
+                layout.write_row(j, part)
+
+    def rows_written(self, rows):
+        for layout in self.layouts:
+            layout.rows_written(rows)
+
+    def checkpoint(self):
+        parts = [layout.checkpoint() for layout in self.layouts]
+        return min(rows for rows, _ in parts), {"parts": parts}
+
+    def abort(self):
+        for layout in self.layouts:
+            layout.abort()
+
+    def close(self):
+        for layout in self.layouts:
+            layout.close()
+
+
+class MultiDeduplicator:
+    """A TripleDeduplicator per mapping, for separate outputs: each output is deduplicated on its own."""
+
+    def __init__(self, dedups):
+        self.dedups = dedups
+
+    def filter(self, triples):
+        return tuple(dedup.filter(part) for dedup, part in zip(self.dedups, triples))
+
+    def close(self):
+        for dedup in self.dedups:
+            dedup.close()
@@ -0,0 +1,531 @@
+"""Serializing triples and routing them to output files."""
+import logging
+import os
+import re
+import zlib
+from functools import lru_cache
+
+from rdflib import BNode, Literal, URIRef
+from urllib.parse import quote
+
+from .compression import COMPRESS_EXTENSIONS, CompressedStream
+from .terms import Prefixes, a, create_uri_from_string, init_kg
+
+logger = logging.getLogger(__name__)
+
+# Streaming formats bypass rdflib Graphs entirely: each row's triples are
+# formatted as N-Triples terms and written to a buffered stream.
+STREAM_EXTENSIONS = {"nt": ".nt", "nq": ".nq", "ttl-stream": ".ttl"}
+
+# IRIREF may not contain control characters, space or <>"{}|^`\ (use UCHAR)
+_iri_escapes = {c: f"\\u{c:04X}" for c in range(0x21)}
+_iri_escapes.update({ord(c): f"\\u{ord(c):04X}" for c in '<>"{}|^`\\'})
+_literal_escapes = {
+    ord("\\"): "\\\\",
+    ord('"'): '\\"',
+    ord("\n"): "\\n",
+    ord("\r"): "\\r",
+}
+# Most terms need no escaping; finding that out is far cheaper than translate()
+_iri_unsafe = re.compile(r'[\x00-\x20<>"{}|^`\\]').search
+_literal_unsafe = re.compile(r'[\\"\n\r]').search
+
+
+def nt_iri(iri):
+    """Format an IRI in N-Triples syntax."""
+    if _iri_unsafe(iri) is None:
+        return f"<{iri}>"
+    return f"<{iri.translate(_iri_escapes)}>"
+
+
+def nt_term(term):
+    """Format an rdflib term in N-Triples syntax."""
+    if isinstance(term, Literal):
+        lexical = str(term)
+        if _literal_unsafe(lexical) is not None:
+            lexical = lexical.translate(_literal_escapes)
+        if term.language:
+            return f'"{lexical}"@{term.language}'
+        if term.datatype:
+            return f'"{lexical}"^^{nt_constant(term.datatype)}'
+        return f'"{lexical}"'
+    if isinstance(term, BNode):
+        return f"_:{term}"
+    return nt_iri(term)
+
+
+# Predicates, classes and datatypes recur on every row: each is formatted once
+nt_constant = lru_cache(1024)(nt_term)
+
+
+class StreamSerializer:
+    """Encode rows of triples as N-Triples, N-Quads or streamed Turtle."""
+
+    def __init__(self, fmt, prefixes, graph_name=None):
+        self.fmt = fmt
+        self.prefixes = prefixes
+        self.end = f" {nt_term(graph_name)} .\n" if fmt == "nq" else " .\n"
+
+    def header(self):
+        if self.fmt != "ttl-stream":
+            return b""
+        return ("".join(f"@prefix {prefix}: <{ns}> .\n" for prefix, ns in self.prefixes.items()) + "\n").encode("utf-8")
+
+    def serialize(self, triples):
+        """Return the text for one row's (or cv's) triples."""
+        if self.fmt != "ttl-stream":
+            end = self.end
+            return "".join(f"{nt_term(s)} {nt_constant(p)} {nt_constant(o) if p == a else nt_term(o)}{end}"
+                           for s, p, o in triples)
+        # Group by subject, keeping first-seen order
+        subjects = {}
+        for s, p, o in triples:
+            subjects.setdefault(s, []).append((p, o))
+        out = []
+        for s, pos in subjects.items():
+            pairs = " ;\n    ".join(
+                f"a {nt_constant(o)}" if p == a else f"{nt_constant(p)} {nt_term(o)}" for p, o in pos)
+            out.append(f"{nt_term(s)} {pairs} .\n\n")
+        return "".join(out)
+
+    def encode(self, triples):
+        """Return (triple count, utf-8 bytes) for one row's triples."""
+        # Graphs are sets; drop the duplicates a mapping can emit within a row
+        triples = dict.fromkeys(triples)
+        return len(triples), self.serialize(triples).encode("utf-8")
+
+
+class StreamWriter:
+    """
+    Write encoded fragments straight to a buffered output file, compressed
+    if compress is set (see compression.py). Data goes to <output_path>.part,
+    which is renamed into place on close, so a crash never leaves a truncated
+    output file behind. With resume_bytes, an existing .part file is
+    truncated to that length and appended to. bytes counts the uncompressed
+    data written.
+    """
+
+    def __init__(self, output_path, header=b"", resume_bytes=None, compress=None):
+        self.output_path = output_path
+        self.part_path = output_path + ".part"
+        self.triples = 0
+        if resume_bytes is None:
+            self.stream = open_output(self.part_path, compress)
+            self.bytes = 0
+            if header:
+                self.stream.write(header)
+                self.bytes += len(header)
+        else:
+            stream = open(self.part_path, "r+b", buffering=1 << 20)
+            stream.truncate(resume_bytes)
+            stream.seek(resume_bytes)
+            self.stream = CompressedStream(stream, compress) if compress is not None else stream
+            self.bytes = resume_bytes
+
+    def write(self, fragment):
+        count, data = fragment
+        self.stream.write(data)
+        self.triples += count
+        self.bytes += len(data)
+
+    def flush(self):
+        """Make everything written so far durable; return the length of the file on disk."""
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        return self.stream.tell()
+
+    def abort(self):
+        if isinstance(self.stream, CompressedStream):
+            self.stream.abort()
+        else:
+            self.stream.close()
+
+    def close(self):
+        self.stream.close()
+        os.replace(self.part_path, self.output_path)
+
+
+def open_output(path, compress=None):
+    """Open a binary output file, compressed on a background thread if compress is set."""
+    stream = open(path, "wb", buffering=1 << 20)
+    if compress is None:
+        return stream
+    return CompressedStream(stream, compress)
+
+
+class TurtleWriter:
+    """Collect triples in an rdflib Graph and serialize it as Turtle on close."""
+
+    def __init__(self, output_path, prefixes, compress=None):
+        self.output_path = output_path
+        self.compress = compress
+        self.graph = init_kg(prefixes)
+
+    @property
+    def triples(self):
+        return len(self.graph)
+
+    def write(self, triples):
+        for triple in triples:
+            self.graph.add(triple)
+
+    def abort(self):
+        self.graph = None
+
+    def close(self):
+        part_path = self.output_path + ".part"
+        if self.compress is None:
+            self.graph.serialize(format="turtle", encoding="utf-8",
+                                 destination=part_path)
+        else:
+            stream = open_output(part_path, self.compress)
+            stream.write(self.graph.serialize(format="turtle", encoding="utf-8"))
+            stream.close()
+        os.replace(part_path, self.output_path)
+
+
+def subject_partition(subject, partitions):
+    """
+    The partition (0 to partitions - 1) of a subject: a CRC-32 of its UTF-8
+    form, so it is the same in every process and every run.
+    """
+    return zlib.crc32(subject.encode("utf-8")) % partitions
+
+
+class OutputSettings:
+    """
+    Where and how output files are written: the output directory, format
+    (ttl, nt, nq or ttl-stream), layout (row, file, shard or partition) and
+    its limits or partition count, the N-Quads graph name (a URI or prefixed
+    name; None for the default), and the compression (gzip, zstd or None).
+    With delta (nt or sparql), only the changes since the previous run are
+    written, as N-Triples (see delta.py); the format and layout are ignored.
+    """
+
+    def __init__(self, output_dir, prefixes, fmt="ttl", layout=None,
+                 shard_triples=None, shard_bytes=None, graph=None, compress=None,
+                 partitions=None, delta=None):
+        self.output_dir = output_dir
+        self.prefixes = prefixes
+        self.fmt = fmt
+        self.delta = delta
+        if delta is not None:
+            self.fmt = "nt"
+            layout = "delta"
+        elif layout is None:
+            if partitions is not None:
+                layout = "partition"
+            else:
+                layout = "row" if fmt == "ttl" else "file"
+        self.layout = layout
+        self.shard_triples = shard_triples
+        self.shard_bytes = shard_bytes
+        self.graph = graph
+        self.compress = compress
+        self.partitions = partitions
+
+    def graph_name(self, base):
+        if self.graph is None:
+            return URIRef(f"{self.prefixes[self.prefixes.default]}graph.{quote(base, safe='')}")
+        if "://" in self.graph:
+            return URIRef(self.graph)
+        return create_uri_from_string(self.graph, self.prefixes)
+
+    def open_layout(self, base):
+        """The OutputLayout (or DeltaLayout) for the input file named base."""
+        if self.layout == "delta":
+            from .delta import DeltaLayout
+            return DeltaLayout(base, self)
+        return OutputLayout(base, self)
+
+    def describe(self):
+        """The settings that change the output, as recorded in the run manifest."""
+        settings = {
+            "format": self.fmt,
+            "layout": self.layout,
+            "shard_triples": self.shard_triples,
+            "shard_bytes": self.shard_bytes,
+            "graph": self.graph,
+            "compress": self.compress,
+            "partitions": self.partitions,
+        }
+        if self.delta is not None:
+            settings["delta"] = self.delta
+        return settings
+
+
+class OutputLayout:
+    """
+    Route the fragments generated from one input file to output files.
+    - row:   output-<base>-<j>.<ext>, one file per row (and per cv)
+    - file:  output-<base>.<ext>, one file per input file
+    - shard: output-<base>-part-<k>.<ext>, rolling over every N triples/bytes
+    - partition: output-<base>-partition-<k>.<ext>, one file per partition,
+      each triple going to the partition of its subject
+    Controlled vocabularies go to output-cv-<base>[-<i>].<ext>, except in
+    the partition layout, where they are partitioned like any other triple.
+    Outside the partition layout, rows are never split across files.
+    committed holds the (rows, state) a later run can safely resume from.
+    """
+
+    def __init__(self, base, settings):
+        self.base = base
+        self.settings = settings
+        self.layout = settings.layout
+        self.ext = STREAM_EXTENSIONS.get(settings.fmt, ".ttl")
+        if settings.compress is not None:
+            self.ext += COMPRESS_EXTENSIONS[settings.compress]
+        self.serializer = None
+        if settings.fmt != "ttl":
+            graph_name = settings.graph_name(base) if settings.fmt == "nq" else None
+            self.serializer = StreamSerializer(settings.fmt, settings.prefixes, graph_name)
+        self.writer = None
+        # One writer per partition, in the partition layout
+        self.writers = None
+        self.shard = 0
+        self.rows = 0
+        self.committed = (0, {})
+
+    def resume(self, rows, state):
+        """Pick up from a checkpoint; return the index of the first row still to write."""
+        if rows == 0:
+            return 0
+        if self.layout == "shard":
+            self.shard = state["shard"]
+        elif self.layout == "file":
+            output_path = os.path.join(self.settings.output_dir, f"output-{self.base}{self.ext}")
+            part_path = output_path + ".part"
+            if (self.serializer is None or "bytes" not in state
+                    or not os.path.exists(part_path)
+                    or os.path.getsize(part_path) < state["bytes"]):
+                return 0
+            logger.info(f"Appending to: {part_path}")
+            self.writer = StreamWriter(output_path, resume_bytes=state["bytes"],
+                                       compress=self.settings.compress)
+        elif self.layout == "partition":
+            output_paths = [os.path.join(self.settings.output_dir, self.partition_file(k))
+                            for k in range(self.settings.partitions)]
+            sizes = state.get("bytes")
+            if (self.serializer is None or sizes is None or len(sizes) != len(output_paths)
+                    or not all(os.path.exists(path + ".part") and os.path.getsize(path + ".part") >= size
+                               for path, size in zip(output_paths, sizes))):
+                return 0
+            for path in output_paths:
+                logger.info(f"Appending to: {path}.part")
+            self.writers = [StreamWriter(path, resume_bytes=size, compress=self.settings.compress)
+                            for path, size in zip(output_paths, sizes)]
+        self.rows = rows
+        self.committed = (rows, state)
+        return rows
+
+    def encode(self, triples):
+        """
+        Turn one row's triples into the fragment that write_row() expects:
+        encoded bytes for the streaming formats, the triples themselves for ttl.
+        In the partition layout, the fragment is {partition: fragment}.
+        Fragments are picklable, so workers can do this part of the work.
+        """
+        if self.layout == "partition":
+            return {k: self.encode_part(part) for k, part in self.partition(triples).items()}
+        return self.encode_part(triples)
+
+    def encode_part(self, triples):
+        if self.serializer is None:
+            return triples
+        return self.serializer.encode(triples)
+
+    def partition(self, triples):
+        """Split triples into {partition: triples} by the partition of their subject."""
+        partitions = self.settings.partitions
+        parts = {}
+        subject_parts = {}
+        for triple in triples:
+            subject = triple[0]
+            k = subject_parts.get(subject)
+            if k is None:
+                k = subject_parts[subject] = subject_partition(subject, partitions)
+            parts.setdefault(k, []).append(triple)
+        return parts
+
+    def row_triples(self, triples):
+        """The number of triples in one row's triples, as given to encode()."""
+        return len(triples)
+
+    def fragment_triples(self, fragment):
+        """The number of triples in a fragment from encode()."""
+        if self.layout == "partition":
+            return sum(self.fragment_triples_part(part) for part in fragment.values())
+        return self.fragment_triples_part(fragment)
+
+    def fragment_triples_part(self, fragment):
+        return fragment[0] if self.serializer is not None else len(fragment)
+
+    def partition_file(self, k):
+        return f"output-{self.base}-partition-{k:05d}{self.ext}"
+
+    def open_writer(self, output_file):
+        output_path = os.path.join(self.settings.output_dir, output_file)
+        logger.info(f"Writing: {output_path}")
+        if self.serializer is None:
+            return TurtleWriter(output_path, self.settings.prefixes, self.settings.compress)
+        return StreamWriter(output_path, self.serializer.header(), compress=self.settings.compress)
+
+    def write_cvs(self, cv_plans, dedup=None):
+        if not cv_plans:
+            return
+        if self.layout == "partition":
+            for cv_type, cv_triples in cv_plans:
+                logger.info(f"Serializing the cv fragment: '{cv_type}'")
+                if dedup is not None:
+                    cv_triples = dedup.filter(cv_triples)
+                self.write_partitions(self.encode(cv_triples))
+            return
+        if self.layout == "row":
+            for i, (cv_type, cv_triples) in enumerate(cv_plans):
+                logger.info(f"Serializing the cv fragment: '{cv_type}'")
+                if dedup is not None:
+                    cv_triples = dedup.filter(cv_triples)
+                writer = self.open_writer(f"output-cv-{self.base}-{i}{self.ext}")
+                writer.write(self.encode(cv_triples))
+                writer.close()
+            return
+        writer = self.open_writer(f"output-cv-{self.base}{self.ext}")
+        for cv_type, cv_triples in cv_plans:
+            logger.info(f"Serializing the cv fragment: '{cv_type}'")
+            if dedup is not None:
+                cv_triples = dedup.filter(cv_triples)
+            writer.write(self.encode(cv_triples))
+        writer.close()
+
+    def write_partitions(self, fragment):
+        if self.writers is None:
+            # Every partition gets a file, even one no triple is routed to
+            self.writers = [self.open_writer(self.partition_file(k))
+                            for k in range(self.settings.partitions)]
+        for k, part in fragment.items():
+            self.writers[k].write(part)
+
+    def write_row(self, j, fragment):
+        self.rows = j + 1
+        if self.layout == "partition":
+            self.write_partitions(fragment)
+            return
+        if self.layout == "row":
+            writer = self.open_writer(f"output-{self.base}-{j}{self.ext}")
+            writer.write(fragment)
+            writer.close()
+            self.committed = (self.rows, {})
+            return
+        if self.writer is None:
+            if self.layout == "file":
+                self.writer = self.open_writer(f"output-{self.base}{self.ext}")
+            else:
+                self.writer = self.open_writer(f"output-{self.base}-part-{self.shard:05d}{self.ext}")
+                self.shard += 1
+        self.writer.write(fragment)
+        if self.layout == "shard" and self.shard_full():
+            self.writer.close()
+            self.writer = None
+            self.committed = (self.rows, {"shard": self.shard})
+
+    def rows_written(self, rows):
+        """Record rows whose files were written elsewhere (by workers, in the row layout)."""
+        self.rows = rows
+        self.committed = (rows, {})
+
+    def checkpoint(self):
+        """Make everything written so far durable where the layout allows it; return committed."""
+        if self.layout == "file" and isinstance(self.writer, StreamWriter):
+            self.committed = (self.rows, {"bytes": self.writer.flush()})
+        elif self.layout == "partition" and self.serializer is not None and self.writers is not None:
+            self.committed = (self.rows, {"bytes": [writer.flush() for writer in self.writers]})
+        return self.committed
+
+    def shard_full(self):
+        shard_triples, shard_bytes = self.settings.shard_triples, self.settings.shard_bytes
+        if shard_triples is not None and self.writer.triples >= shard_triples:
+            return True
+        return shard_bytes is not None and self.writer.bytes >= shard_bytes
+
+    def abort(self):
+        """Stop without publishing the open file; its .part stays behind for a resume."""
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+        for writer in self.writers or ():
+            writer.abort()
+        self.writers = None
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.layout == "partition" and self.writers is None:
+            # An input without rows or cvs still gets its partitions
+            self.write_partitions({})
+        for writer in self.writers or ():
+            # Each partition is published as soon as it is complete
+            writer.close()
+        self.writers = None
+
+
+
+def write(triples, destination, fmt="nt", prefixes=None, graph=None, chunk_size=10000,
+          compress=None):
+    """
+    Write triples to destination, a file path or a binary stream, and return
+    how many were written. The streaming formats (nt, nq, ttl-stream) write as
+    triples arrive, chunk_size at a time; ttl builds a Graph and writes on the end.
+    A path is written through <path>.part and renamed into place once complete,
+    compressed with compress (gzip or zstd) if it is set.
+    """
+    if prefixes is None:
+        prefixes = Prefixes("https://example.com/")
+    if fmt == "ttl":
+        graph_out = init_kg(prefixes)
+        for triple in triples:
+            graph_out.add(triple)
+        data = graph_out.serialize(format="turtle", encoding="utf-8")
+        if hasattr(destination, "write"):
+            destination.write(data)
+        else:
+            stream = open_output(destination + ".part", compress)
+            stream.write(data)
+            stream.close()
+            os.replace(destination + ".part", destination)
+        return len(graph_out)
+
+    if fmt not in STREAM_EXTENSIONS:
+        raise Exception(f"Unknown output format: {fmt}")
+    graph_name = None
+    if fmt == "nq":
+        if graph is not None and "://" in graph:
+            graph_name = URIRef(graph)
+        else:
+            graph_name = create_uri_from_string(graph or "graph", prefixes)
+    serializer = StreamSerializer(fmt, prefixes, graph_name)
+    if hasattr(destination, "write"):
+        stream, writer = destination, None
+        stream.write(serializer.header())
+    else:
+        writer = StreamWriter(destination, serializer.header(), compress=compress)
+        stream = writer.stream
+    count = 0
+    try:
+        chunk = []
+        for triple in triples:
+            chunk.append(triple)
+            if len(chunk) >= chunk_size:
+                stream.write(serializer.serialize(chunk).encode("utf-8"))
+                count += len(chunk)
+                chunk = []
+        stream.write(serializer.serialize(chunk).encode("utf-8"))
+        count += len(chunk)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+            os.remove(writer.part_path)
+        raise
+    if writer is not None:
+        writer.close()
+    return count
@@ -0,0 +1,116 @@
+"""
+The stages of the row loop on their own threads (--pipeline-depth).
+
+Reading an input and writing the output mostly wait on the disk (or the
+network, for mounted storage), while transforming rows keeps the CPU
+busy. With a pipeline, batches are read ahead on a reader thread and the
+encoded fragments are written on a writer thread, so that both waits
+overlap with transforming the next batches on the main thread. The stages
+are connected by queues holding at most depth batches each, so a slow
+stage holds back the others (backpressure) instead of letting batches pile
+up in memory. Batches go through every stage in order, so the output is
+the same as without a pipeline.
+"""
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the items going through a stage
+_END = object()
+
+
+def prefetch(items, depth, name="foundry-read"):
+    """
+    Iterate items on a thread, up to depth items ahead of the consumer.
+    An error raised by items is raised in the consumer; closing the
+    returned iterator stops the thread. With depth 0, items is returned as is.
+    """
+    if depth < 1:
+        return items
+    return iter_prefetched(items, depth, name)
+
+
+def iter_prefetched(items, depth, name):
+    results = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(result):
+        # Give up once the consumer is gone, rather than wait on a full queue
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as e:
+            put((_END, e))
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = results.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundStage:
+    """
+    Call function on each item put, in order, on a thread, with at most
+    depth items waiting. An error in function is raised by the next put()
+    or by close(); the items after it are dropped.
+    """
+
+    def __init__(self, function, depth, name="foundry-write"):
+        self.function = function
+        self.queue = queue.Queue(max(depth, 1))
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.work, name=name, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if self.error is not None or self.stopped:
+                continue
+            try:
+                self.function(item)
+            except BaseException as e:
+                self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        """Wait for every item put to be handled."""
+        self.queue.put(_END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """Drop the items still waiting, and wait for the one being handled."""
+        self.stopped = True
+        self.queue.put(_END)
+        self.thread.join()
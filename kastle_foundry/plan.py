@@ -0,0 +1,528 @@
+"""Compiling a mapping into a plan, and applying the plan to rows."""
+import itertools
+import logging
+
+from rdflib import Literal, URIRef
+from urllib.parse import quote
+
+from .inputs import BoundRow, compile_xml_paths, is_xml, iter_batches, iter_rows, row_values
+from .diagnostics import Diagnostics
+from .interning import CACHE_SIZE, TermCache, trusted_uri, uri_maker
+from .literals import LiteralCodec, log_invalid_literals
+from .lookups import compile_lookups
+from .mapping import log_message_with_node, mapping_error, mapping_root
+from .terms import Prefixes, a, create_uri_from_string
+
+logger = logging.getLogger(__name__)
+
+# The YAML mapping is compiled once into a tree of plan nodes. All URIs,
+# predicate lists, datatypes and varids are resolved up front, so the
+# per-row work is reduced to reading the row and emitting triples.
+# Each plan node has an apply(row, emit) method that emits its triples
+# through emit((s, p, o)) and returns the term that represents the node
+# (or None if there is nothing to link to). Nodes are labelled with their
+# path in the mapping (e.g. "root.connections[1].o") and carry a NodeStats
+# when metrics are enabled (stats is None otherwise). The terms minted from
+# rows are interned in TermCaches (see interning.py).
+
+class NodeStats:
+    """Per-node counters collected when metrics are enabled."""
+    __slots__ = ("applied", "triples", "skipped", "warnings")
+
+    def __init__(self):
+        self.applied = 0
+        self.triples = 0
+        self.skipped = 0
+        self.warnings = 0
+
+
+class RowTriples(list):
+    """One row's triples, with the term of the root node as subject (the key of the row in --delta runs)."""
+    __slots__ = ("subject",)
+
+    def __init__(self, triples=(), subject=None):
+        super().__init__(triples)
+        self.subject = subject
+
+
+class ConstantPlan:
+    """A URI string used directly as the object of a connection."""
+    __slots__ = ("path", "uri", "stats")
+    kind = "constant"
+
+    def __init__(self, path, uri):
+        self.path = path
+        self.uri = uri
+        self.stats = None
+
+    def apply(self, row, emit):
+        if self.stats is not None:
+            self.stats.applied += 1
+        return self.uri
+
+
+class LiteralPlan:
+    """A datatype node, minted from the row (val_source) or a constant (value)."""
+    __slots__ = ("path", "node", "datatype", "sources", "constant", "required", "codec", "stats")
+    kind = "literal"
+
+    def __init__(self, path, node, datatype, sources, constant, required):
+        self.path = path
+        self.node = node
+        self.datatype = datatype
+        self.sources = sources
+        self.constant = constant
+        self.required = required
+        # Validates and encodes the values read from the row
+        self.codec = LiteralCodec(datatype, path) if sources else None
+        self.stats = None
+
+    def apply(self, row, emit):
+        stats = self.stats
+        if stats is not None:
+            stats.applied += 1
+        if not self.sources:
+            return self.constant
+
+        # The first non-empty val_source wins
+        for source in self.sources:
+            val = row.get(source, "")
+            if isinstance(val, str):
+                val = val.strip()
+            if val not in (None, ""):
+                # Encode the data
+                # There should never be a connection from a datatype node
+                return self.codec.encode(val)
+
+        # Reported by the connection it is the target of (see Diagnostics.empty_value())
+        if stats is not None:
+            stats.skipped += 1
+            stats.warnings += 1
+        return None
+
+
+class ConnectionPlan:
+    """
+    A compiled connection: the target plan, its predicates and optional inverse.
+    With foreach, the target branch is applied once per value of that source.
+    """
+    __slots__ = ("node", "target", "preds", "inv", "foreach", "separator", "path", "empty_literal")
+
+    def __init__(self, node, target, preds, inv, foreach=None, separator=None, path=None):
+        self.node = node
+        self.target = target
+        self.preds = preds
+        self.inv = inv
+        self.foreach = foreach
+        self.separator = separator
+        self.path = path
+        # Whether an empty target is a datatype node without a value
+        self.empty_literal = isinstance(target, LiteralPlan) and bool(target.sources)
+
+    def targets(self, row, emit):
+        if self.foreach is None:
+            return (self.target.apply(row, emit),)
+        return [self.target.apply(BoundRow(row, self.foreach, value), emit)
+                for value in row_values(row, self.foreach, self.separator)]
+
+
+class InstancePlan:
+    """An instance node with its URI pattern, types and outgoing connections."""
+    __slots__ = ("path", "node", "base", "varids", "suffix", "types", "connections", "stats", "diagnostics",
+                 "uri", "pattern", "make_uri", "terms", "row_uris")
+    kind = "instance"
+
+    def __init__(self, path, node, base, varids, suffix, types, connections):
+        self.path = path
+        self.node = node
+        self.base = base
+        self.varids = varids
+        self.suffix = suffix
+        self.types = types
+        self.connections = connections
+        self.stats = None
+        # Shared by every node of a CompiledMapping
+        self.diagnostics = Diagnostics()
+        # Without varids, the URI is the same for every row
+        self.uri = URIRef(base) if varids is None else None
+        self.pattern = (base, varids, suffix)
+        self.make_uri = uri_maker(base + ".", suffix)
+        # URIs by varid values, shared by the nodes with the same pattern (see attach_term_caches())
+        self.terms = TermCache(path, self.build_uri) if varids is not None else None
+        # The URIs built for the current row, when another node has the same pattern
+        self.row_uris = None
+
+    def build_uri(self, values):
+        return self.make_uri(self.base + "." + ".".join([quote(v, safe="") for v in values]) + self.suffix)
+
+    def instance_uri(self, row):
+        if self.varids is None:
+            return self.uri
+        try:
+            values = tuple([row[varid] for varid in self.varids])
+        except KeyError:
+            msg = "Variable ID missing from data file"
+            log_message_with_node(msg, self.node, error_type="error")
+            raise Exception(msg)
+        row_uris = self.row_uris
+        if row_uris is None:
+            return self.terms.get(values)
+        key = (self.pattern, values)
+        uri = row_uris.get(key)
+        if uri is None:
+            uri = row_uris[key] = self.terms.get(values)
+        return uri
+
+    def apply(self, row, emit):
+        instance_uri = self.instance_uri(row)
+        stats = self.stats
+        if stats is not None:
+            stats.applied += 1
+            stats.triples += len(self.types)
+
+        for class_uri in self.types:
+            emit((instance_uri, a, class_uri))
+
+        # Connect this node to next layer
+        for connection in self.connections:
+            targets = connection.targets(row, emit)
+            target_uris = [t for t in targets if t is not None]
+
+            if len(target_uris) < len(targets) and connection.empty_literal:
+                self.diagnostics.empty_value(connection.target, [instance_uri])
+            if not target_uris:
+                if stats is not None:
+                    stats.warnings += 1
+                self.diagnostics.no_target(connection, [instance_uri])
+                continue
+
+            if stats is not None:
+                links = len(connection.preds) + (connection.inv is not None)
+                stats.triples += links * len(target_uris)
+
+            for target_uri in target_uris:
+                for pred_uri in connection.preds:
+                    emit((instance_uri, pred_uri, target_uri))
+
+                if connection.inv is not None:
+                    emit((target_uri, connection.inv, instance_uri))
+
+        return instance_uri
+
+
+def compile_literal(mapping, prefixes, path):
+    datatype = create_uri_from_string(mapping["datatype"], prefixes)
+    required = mapping.get("required", False)
+
+    # There are two ways to get the value, with val_source checked first
+    # The spec says that val_source and value are exlusive
+    if "val_source" in mapping:
+        val_source = mapping["val_source"]
+        if not isinstance(val_source, list):
+            val_source = [val_source]
+        return LiteralPlan(path, mapping, datatype, tuple(val_source), None, required)
+
+    if "value" in mapping:
+        # The data is hardcoded as part of the mapping, so mint it once
+        val = mapping["value"]
+        if isinstance(val, str):
+            val = val.strip()
+        if val in (None, ""):
+            msg = "Invalid 'value' for a datatype node"
+            log_message_with_node(msg, mapping, error_type="error" if required else "warning")
+            return LiteralPlan(path, mapping, datatype, (), None, required)
+        return LiteralPlan(path, mapping, datatype, (), Literal(val, datatype=datatype), required)
+
+    msg = "'value' or 'val_source' must be defined for a datatype node"
+    log_message_with_node(msg, mapping, error_type="error" if required else "warning")
+    return LiteralPlan(path, mapping, datatype, (), None, required)
+
+
+def compile_instance(mapping, prefixes, path):
+    if "uri" not in mapping:
+        mapping_error("Instance node is missing 'uri'", mapping)
+    base = str(create_uri_from_string(mapping["uri"], prefixes))
+
+    varids = None
+    suffix = ""
+    if "varids" in mapping:
+        varids = tuple(mapping["varids"])
+        if "appellation" in mapping:
+            suffix = "." + mapping["appellation"]
+        else:
+            log_message_with_node("Appellation not defined, skipping", mapping, error_type="info") # Appellation is optional
+    else:
+        log_message_with_node("Varids not defined, skipping", mapping, error_type="warning") # Varids are optional, if unusual to be so
+
+    # Detect if there are multiple types
+    types = list()
+    if "type" in mapping:
+        type_names = mapping["type"]
+        if isinstance(type_names, str):
+            type_names = [type_names]
+        for t in type_names:
+            # Declare the class (i.e., type) of this node
+            types.append(create_uri_from_string(t, prefixes))
+    elif not mapping.get("ref", False):
+        # If 'ref' is not explicitly defined, then it is false.
+        log_message_with_node(f"Added instance without type: {base}", mapping, error_type="warning")
+
+    connections = list()
+    if "connections" in mapping:
+        for i, connection in enumerate(mapping["connections"]):
+            connections.append(compile_connection(connection, prefixes, f"{path}.connections[{i}]"))
+    else:
+        # There are no downstream connections, which is ok.
+        log_message_with_node("No connections defined, skipping", mapping, error_type="info")
+
+    return InstancePlan(path, mapping, base, varids, suffix, tuple(types), tuple(connections))
+
+
+def compile_connection(connection, prefixes, path):
+    if not isinstance(connection, dict):
+        mapping_error("Connection must be a mapping with 'p' and 'o'", {"connection": connection})
+    for key in ("p", "o"):
+        if key not in connection:
+            mapping_error(f"Connection is missing '{key}'", connection)
+
+    target = compile_node(connection["o"], prefixes, f"{path}.o")
+
+    # Get URI(s) for predicates
+    preds = connection["p"]
+    if not isinstance(preds, list):
+        preds = [preds]
+    pred_uris = tuple(create_uri_from_string(pred, prefixes) for pred in preds)
+
+    inv_uri = None
+    if "inv" in connection:
+        inv_uri = create_uri_from_string(connection["inv"], prefixes)
+    else:
+        # There is no inverse, which is ok.
+        log_message_with_node("No inverse connection defined, skipping", {"predicate": preds}, error_type="info")
+
+    foreach = connection.get("foreach")
+    separator = connection.get("separator")
+    if foreach is not None and not isinstance(foreach, str):
+        mapping_error("'foreach' must name a single source field", connection)
+    if separator is not None and foreach is None:
+        log_message_with_node("'separator' has no effect without 'foreach'", connection, error_type="warning")
+
+    return ConnectionPlan(connection, target, pred_uris, inv_uri, foreach, separator, path)
+
+
+def compile_node(mapping, prefixes, path="root"):
+    # Case 1: URI string
+    if isinstance(mapping, str):
+        return ConstantPlan(path, create_uri_from_string(mapping, prefixes))
+    if not isinstance(mapping, dict):
+        mapping_error("Mapping node must be a URI string or a mapping", {"node": mapping})
+    # Case 2: Datatype (literal)
+    if "datatype" in mapping:
+        return compile_literal(mapping, prefixes, path)
+    # Case 3: Instance node
+    return compile_instance(mapping, prefixes, path)
+
+
+def iter_plan_nodes(plan):
+    """Yield every node of a compiled plan, depth first."""
+    yield plan
+    for connection in getattr(plan, "connections", ()):
+        yield from iter_plan_nodes(connection.target)
+
+
+def attach_term_caches(root, size=CACHE_SIZE):
+    """
+    Give each datatype node, and each instance URI pattern, a TermCache of
+    size terms (0 turns interning off). Return the per-row URI memo of the
+    nodes that share a pattern, for transform_row() to clear.
+    """
+    patterns = {}
+    for node in iter_plan_nodes(root):
+        if isinstance(node, LiteralPlan) and node.codec is not None:
+            node.codec.terms = TermCache(node.path, node.codec.build, size)
+        elif isinstance(node, InstancePlan) and node.varids is not None:
+            patterns.setdefault(node.pattern, []).append(node)
+    row_uris = {}
+    for nodes in patterns.values():
+        # URIRef() warns about each URI of a pattern that is not clean (see interning.py)
+        terms = TermCache(nodes[0].path, nodes[0].build_uri, size if nodes[0].make_uri is trusted_uri else 0)
+        for node in nodes:
+            node.terms = terms
+            node.row_uris = row_uris if len(nodes) > 1 else None
+    return row_uris
+
+
+def iter_term_caches(root):
+    """Yield every TermCache of a compiled plan once."""
+    seen = set()
+    for node in iter_plan_nodes(root):
+        codec = getattr(node, "codec", None)
+        terms = codec.terms if codec is not None else getattr(node, "terms", None)
+        if terms is not None and id(terms) not in seen:
+            seen.add(id(terms))
+            yield terms
+
+
+def compile_cvs(mapping, prefixes):
+    """Compile the controlled vocabularies into one list of triples per cv."""
+    if "cvs" not in mapping:
+        logger.info("No CVs detected.")
+        return []
+    cv_plans = list()
+    for cv in mapping["cvs"]:
+        for key in ("type", "uri", "instances"):
+            if key not in cv:
+                mapping_error(f"Controlled vocabulary is missing '{key}'", cv)
+        class_uri = create_uri_from_string(cv["type"], prefixes)
+        triples = list()
+        for instance in cv["instances"]:
+            instance_uri = create_uri_from_string(f"{cv['uri']}.{instance}", prefixes)
+            triples.append((instance_uri, a, class_uri))
+        cv_plans.append((cv.get("type", "UNKNOWN_TYPE"), triples))
+    return cv_plans
+
+
+class CompiledMapping:
+    """
+    A mapping compiled for one namespace and prefix. Any mapping error is
+    raised while compiling, before a single row is processed.
+    """
+
+    def __init__(self, mapping, prefixes, term_cache=CACHE_SIZE):
+        self.mapping = mapping
+        self.prefixes = prefixes
+        logger.info("Compiling the mapping.")
+        self.root = compile_node(mapping_root(mapping), prefixes)
+        self.cvs = compile_cvs(mapping, prefixes)
+        self.lookups = compile_lookups(mapping)
+        self.xml_plan = compile_xml_paths(mapping, self.lookups)
+        self.batch_plan = None
+        self.literals = [n for n in iter_plan_nodes(self.root) if getattr(n, "codec", None) is not None]
+        self.diagnostics = Diagnostics()
+        for node in iter_plan_nodes(self.root):
+            if isinstance(node, InstancePlan):
+                node.diagnostics = self.diagnostics
+        self.row_uris = attach_term_caches(self.root, term_cache)
+        self.term_caches = list(iter_term_caches(self.root))
+        # The caches whose hit rate is still being probed
+        self.probed = [terms for terms in self.term_caches if terms.probing]
+        logger.info("Compile success.")
+
+    @property
+    def roots(self):
+        """The plan roots, for RunMetrics (a MultiMapping has one per mapping)."""
+        return [self.root]
+
+    def transform_row(self, row):
+        """Apply the compiled mapping to one row and return its triples (a RowTriples)."""
+        if self.lookups is not None:
+            self.lookups.join_row(row)
+        if self.row_uris:
+            self.row_uris.clear()
+        triples = RowTriples()
+        triples.subject = self.root.apply(row, triples.append)
+        return triples
+
+    def transform(self, rows):
+        """
+        Yield the triples of each row in turn. Triples of shared nodes
+        (ref nodes, constant targets) repeat from row to row.
+        """
+        for row in rows:
+            yield from self.transform_row(row)
+
+    def cv_triples(self):
+        """Yield the triples of the controlled vocabularies."""
+        for _, triples in self.cvs:
+            yield from triples
+
+    def read(self, data_path):
+        """Yield the rows of a CSV or XML file, as the mapping reads them."""
+        return iter_rows(data_path, self.xml_plan)
+
+    def read_batches(self, data_path, start=0, batch_size=1000, engine="auto"):
+        """
+        Yield the rows of a file in batches for transform_batch(), skipping the
+        first start rows. With engine "auto" or "columnar", CSV input is read
+        as column batches when the mapping allows it (see columnar.py); with
+        "row", or otherwise, batches are lists of row dicts.
+        """
+        if engine != "row" and not is_xml(data_path):
+            from .columnar import iter_csv_batches
+            if self.get_batch_plan() is not None:
+                return iter_csv_batches(data_path, self.input_columns(), start, batch_size)
+            if engine == "columnar":
+                logger.info("The mapping uses foreach, so rows are processed one at a time.")
+        rows = self.read(data_path)
+        if start:
+            rows = itertools.islice(rows, start, None)
+        return iter_batches(rows, batch_size)
+
+    def transform_batch(self, batch):
+        """Return the triples of every row of a batch from read_batches(), one list per row."""
+        if isinstance(batch, list):
+            rows = [self.transform_row(row) for row in batch]
+        else:
+            if self.lookups is not None:
+                batch = self.lookups.join_batch(batch)
+            rows = self.get_batch_plan().transform(batch)
+        self.check_term_caches()
+        return rows
+
+    def check_term_caches(self):
+        """Drop the term caches whose probe shows their values do not repeat (see interning.py)."""
+        if self.probed:
+            self.probed = [terms for terms in self.probed if terms.check()]
+
+    def get_batch_plan(self):
+        """The BatchPlan for column batches (see columnar.py), or None if the mapping needs the row path."""
+        if self.batch_plan is None:
+            from .columnar import compile_batch_plan
+            self.batch_plan = compile_batch_plan(self.root)
+        return self.batch_plan
+
+    def input_columns(self):
+        """The CSV columns column batches are read with: the BatchPlan's, with lookup keys for lookup columns."""
+        columns = self.get_batch_plan().columns
+        if self.lookups is not None:
+            columns = self.lookups.input_sources(columns)
+        return columns
+
+    def lookup_versions(self):
+        """The lookup tables and their file versions, for the run manifest ([] without lookups)."""
+        return self.lookups.versions() if self.lookups is not None else []
+
+    def take_invalid_literals(self):
+        """Return and reset the invalid value counts of every datatype node."""
+        return [node.codec.take() for node in self.literals]
+
+    def merge_invalid_literals(self, counts):
+        for node, node_counts in zip(self.literals, counts):
+            node.codec.merge(node_counts)
+
+    def log_invalid_literals(self):
+        """Log, per datatype node, the values that were not valid for its datatype."""
+        log_invalid_literals(self.literals)
+
+    def take_diagnostics(self):
+        """Return and reset the row issues met so far (see diagnostics.py)."""
+        return self.diagnostics.take()
+
+    def merge_diagnostics(self, issues):
+        self.diagnostics.merge(issues)
+
+    def log_diagnostics(self):
+        """Log the row issues of the run as one table."""
+        self.diagnostics.log()
+
+    def diagnostics_report(self):
+        """The row issues of the run, for --diagnostics-out."""
+        return self.diagnostics.report()
+
+
+def compile_mapping(mapping, namespace, prefix="ex", term_cache=CACHE_SIZE):
+    """
+    Compile a loaded mapping for the given base namespace and prefix, with
+    term_cache terms interned per node (0 turns interning off).
+    """
+    return CompiledMapping(mapping, Prefixes(namespace, prefix), term_cache)
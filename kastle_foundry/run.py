@@ -0,0 +1,297 @@
+"""Running a compiled mapping over input files, sequentially or in a process pool."""
+import collections
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .compression import strip_compression
+from .manifest import MANIFEST_FILE, RunManifest
+from .mapping import mapping_hash
+from .metrics import FileMetrics, untimed
+from .pipeline import BackgroundStage, prefetch
+
+logger = logging.getLogger(__name__)
+
+
+def run_settings(compiled, output, dedup=None):
+    """Everything besides the input itself that changes the output."""
+    settings = {
+        "mapping": mapping_hash(compiled.mapping),
+        "namespace": compiled.prefixes.namespace,
+        "prefix": compiled.prefixes.prefix,
+        **output.describe(),
+        "dedup": dedup is not None,
+    }
+    lookups = compiled.lookup_versions()
+    if lookups:
+        settings["lookups"] = lookups
+    return settings
+
+
+def run(compiled, data_paths, output, workers=1, batch_size=1000, checkpoint_every=10000,
+        dedup=None, resume=True, metrics=None, engine="auto", pipeline_depth=2):
+    """
+    Apply a compiled mapping to every input file and write the output
+    described by output (an OutputSettings). compiled may also be a
+    MultiMapping, with a MultiOutput for separate outputs (see multi.py). Rows are read and transformed
+    in batches of batch_size, with the given engine (see
+    CompiledMapping.read_batches()); with workers > 1 the batches are
+    transformed in a process pool. Batches are read ahead, and (without
+    workers) written, on threads of their own, with up to pipeline_depth
+    batches waiting between stages (0 runs every stage in turn, on one
+    thread; see pipeline.py). dedup is an optional
+    TripleDeduplicator, and metrics an optional RunMetrics attached to the
+    compiled plan. Unless resume is False (or dedup is set), inputs already
+    written by an earlier run with the same settings are skipped or resumed;
+    in a delta run (see delta.py), every input is read again, and unchanged
+    rows are skipped instead.
+    """
+    os.makedirs(output.output_dir, exist_ok=True)
+    # Invalid literal counts and row issues are per run, and the compiled mapping may be reused
+    compiled.take_invalid_literals()
+    compiled.take_diagnostics()
+    manifest = RunManifest(os.path.join(output.output_dir, MANIFEST_FILE),
+                           run_settings(compiled, output, dedup),
+                           resume=resume and dedup is None and output.layout != "delta")
+    foundry_run = Run(compiled, output, manifest, dedup, metrics, checkpoint_every, batch_size, engine,
+                      pipeline_depth)
+    try:
+        if workers > 1:
+            foundry_run.write_files_parallel(data_paths, workers)
+        else:
+            for data_path in data_paths:
+                foundry_run.write_file(data_path)
+    finally:
+        manifest.save(force=True)
+        compiled.log_invalid_literals()
+        compiled.log_diagnostics()
+
+
+class Run:
+    """The state shared by the input files of one run."""
+
+    def __init__(self, compiled, output, manifest, dedup=None, metrics=None, checkpoint_every=10000,
+                 batch_size=1000, engine="auto", pipeline_depth=2):
+        self.compiled = compiled
+        self.output = output
+        self.manifest = manifest
+        self.dedup = dedup
+        self.metrics = metrics
+        self.checkpoint_every = checkpoint_every
+        self.batch_size = batch_size
+        self.engine = engine
+        self.pipeline_depth = pipeline_depth
+        self.timed = metrics.timed if metrics is not None else untimed
+
+    def open_input(self, data_path):
+        """
+        Prepare one input file. Returns None if it is unchanged since the last
+        run, else (base, layout, manifest entry, first row index, row batches).
+        """
+        logger.info(f"Opening: {data_path}")
+        base = os.path.splitext(os.path.basename(strip_compression(data_path)))[0]
+        entry = self.manifest.begin(data_path)
+        if entry["complete"]:
+            logger.info(f"Unchanged since the last run, skipping: {data_path}")
+            return None
+        layout = self.output.open_layout(base)
+        start = layout.resume(entry["rows"], entry["state"])
+        if start == 0:
+            # Generate any constants (e.g., controlled vocabularies)
+            layout.write_cvs(self.compiled.cvs, self.dedup)
+        else:
+            logger.info(f"Resuming at row {start}: {data_path}")
+        batches = self.compiled.read_batches(data_path, start, self.batch_size, self.engine)
+        if self.metrics is not None:
+            batches = self.metrics.timed_iter("read", batches)
+        return base, layout, entry, start, prefetch(batches, self.pipeline_depth)
+
+    def write_file(self, data_path):
+        opened = self.open_input(data_path)
+        if opened is None:
+            return
+        base, layout, entry, start, batches = opened
+        timed, dedup, manifest = self.timed, self.dedup, self.manifest
+        transform_batch = self.compiled.transform_batch
+        file_metrics = FileMetrics(data_path)
+
+        def write_batch(item):
+            j, fragments = item
+            for fragment in fragments:
+                timed("write", layout.write_row, j, fragment)
+                j += 1
+                if j % self.checkpoint_every == 0:
+                    manifest.checkpoint(entry, *layout.checkpoint())
+
+        writer = None
+        if self.pipeline_depth > 0:
+            writer = BackgroundStage(write_batch, self.pipeline_depth)
+        j = start
+        try:
+            # Apply the compiled mapping to each batch of rows
+            for batch in batches:
+                fragments = []
+                for triples in timed("transform", transform_batch, batch):
+                    if dedup is not None:
+                        triples = timed("dedup", dedup.filter, triples)
+                    file_metrics.triples += layout.row_triples(triples)
+                    fragments.append(timed("encode", layout.encode, triples))
+                if writer is not None:
+                    writer.put((j, fragments))
+                else:
+                    write_batch((j, fragments))
+                j += len(fragments)
+            if writer is not None:
+                writer.close()
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            close_batches(batches)
+            layout.abort()
+            raise
+        timed("write", layout.close)
+        manifest.complete(entry, layout.rows)
+        logger.info("Serialized.")
+        if self.metrics is not None:
+            file_metrics.rows = layout.rows - start
+            self.metrics.file_done(file_metrics)
+
+    # ----------------------------------------------------------------
+    # Parallel execution
+    # ----------------------------------------------------------------
+    # Rows are independent, so batches of rows (from one large file, or from
+    # many files in a directory) are transformed and encoded in a process pool.
+    # The parent writes the returned fragments in submission order, so the
+    # output is byte-identical to a sequential run.
+
+    def write_files_parallel(self, data_paths, workers):
+        # Prefer fork so workers inherit the compiled plan instead of unpickling it
+        if "fork" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("fork")
+        else:
+            mp_context = None
+        timed, dedup, manifest, metrics = self.timed, self.dedup, self.manifest, self.metrics
+
+        # (layout, manifest entry, file metrics, first row index, row count, future);
+        # a None future marks the end of a file
+        pending = collections.deque()
+        open_layouts = []
+        batches = None
+
+        def drain(limit):
+            while len(pending) > limit:
+                layout, entry, file_metrics, start, count, future = pending.popleft()
+                if future is None:
+                    timed("write", layout.close)
+                    open_layouts.remove(layout)
+                    manifest.complete(entry, layout.rows)
+                    logger.info("Serialized.")
+                    if metrics is not None:
+                        metrics.file_done(file_metrics)
+                    continue
+                fragments, triples, snapshot, invalid, issues = future.result()
+                if snapshot is not None:
+                    metrics.merge(snapshot)
+                self.compiled.merge_invalid_literals(invalid)
+                self.compiled.merge_diagnostics(issues)
+                file_metrics.rows += count
+                if layout.layout == "row" and dedup is None:
+                    layout.rows_written(start + count)
+                    file_metrics.triples += triples
+                else:
+                    for j, fragment in enumerate(fragments, start):
+                        if dedup is not None:
+                            # Deduplicate in row order, so the output matches a sequential run
+                            fragment = timed("dedup", dedup.filter, fragment)
+                            file_metrics.triples += layout.row_triples(fragment)
+                            fragment = timed("encode", layout.encode, fragment)
+                        else:
+                            file_metrics.triples += layout.fragment_triples(fragment)
+                        timed("write", layout.write_row, j, fragment)
+                manifest.checkpoint(entry, *layout.checkpoint())
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                                     initializer=init_worker,
+                                     initargs=(self.compiled, self.output, metrics)) as pool:
+                for data_path in data_paths:
+                    opened = self.open_input(data_path)
+                    if opened is None:
+                        continue
+                    base, layout, entry, start, batches = opened
+                    open_layouts.append(layout)
+                    file_metrics = FileMetrics(data_path)
+                    for batch in batches:
+                        future = pool.submit(process_batch, base, start, batch, dedup is None)
+                        pending.append((layout, entry, file_metrics, start, len(batch), future))
+                        start += len(batch)
+                        # Bound the number of batches held in memory
+                        drain(workers * 2)
+                    pending.append((layout, entry, file_metrics, start, 0, None))
+                drain(0)
+        except BaseException:
+            close_batches(batches)
+            for layout in open_layouts:
+                layout.abort()
+            raise
+
+
+def close_batches(batches):
+    """Stop reading ahead (see pipeline.prefetch()) when a file is abandoned."""
+    close = getattr(batches, "close", None)
+    if close is not None:
+        close()
+
+
+# (compiled mapping, output settings, metrics) of a worker process
+_worker = None
+# (base, layout) of the worker's last batch
+_worker_layout = None
+
+
+def init_worker(compiled, output, metrics):
+    global _worker, _worker_layout
+    # A forked worker starts with a copy of the parent's counters
+    if metrics is not None:
+        metrics.reset()
+    _worker = (compiled, output, metrics)
+    _worker_layout = None
+
+
+def worker_layout(output, base):
+    """
+    The worker's layout for the input file named base, kept across its batches:
+    a delta layout maps the previous state of the file once, not once per batch.
+    """
+    global _worker_layout
+    if _worker_layout is None or _worker_layout[0] != base:
+        if _worker_layout is not None:
+            # Nothing was written through it; this only releases the previous state
+            _worker_layout[1].abort()
+        _worker_layout = (base, output.open_layout(base))
+    return _worker_layout[1]
+
+
+def process_batch(base, start, batch, encode=True):
+    """
+    Worker entry point: transform and encode a batch of rows from one input file.
+    With encode=False the raw triples are returned, for the parent to deduplicate.
+    Returns (fragments, triple count, metrics snapshot or None, invalid literal counts, row issues).
+    """
+    compiled, output, metrics = _worker
+    timed = metrics.timed if metrics is not None else untimed
+    batch_triples = timed("transform", compiled.transform_batch, batch)
+    layout = worker_layout(output, base)
+    count = sum(layout.row_triples(triples) for triples in batch_triples)
+    if not encode:
+        fragments = batch_triples
+    else:
+        fragments = [timed("encode", layout.encode, triples) for triples in batch_triples]
+        if layout.layout == "row":
+            # Row files are independent of each other, so write them here
+            for j, fragment in enumerate(fragments, start):
+                timed("write", layout.write_row, j, fragment)
+            fragments = []
+    snapshot = metrics.snapshot() if metrics is not None else None
+    return fragments, count, snapshot, compiled.take_invalid_literals(), compiled.take_diagnostics()
@@ -0,0 +1,291 @@
+"""
+Serving many jobs from one warm process.
+
+    python kastle-foundry.py serve [--watch DIR | --socket PATH] [-v] [--log-file LOG]
+
+Each job is one Foundry run, given as the same arguments as the command
+line. Python, rdflib and the other modules are started once, and compiled
+mappings are cached by mapping file (path and modification time),
+namespace and prefix, so a job only pays for reading and writing its data.
+
+Jobs are JSON objects, {"id": ..., "args": [...]} ("args" may also be one
+string, split like a shell command line), read from:
+- stdin (the default), one per line; results are written to stdout, one
+  JSON line per job;
+- a Unix socket (--socket), one per line on a connection; each result is
+  written back on the same connection;
+- a watched directory (--watch), one per *.json file. Finished jobs are
+  moved to done/ (or failed/) next to a <name>.result.json.
+
+Each result holds the job id, "ok" or "error" (with the message), whether
+the mapping came from the cache, and the job's timings. Jobs run one at a
+time, in the order they arrive; --workers within a job still applies.
+Logging is set up once for the server, so -v and --log-file in a job's
+arguments have no effect. Relative paths are relative to the server's
+working directory.
+"""
+import argparse
+import json
+import logging
+import os
+import shlex
+import socket
+import socketserver
+import stat
+import sys
+import time
+
+from .cli import configure_logging, parse_args, run_job
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """A job that could not be started (bad JSON or arguments)."""
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    """
+    Raise argument errors instead of exiting the server. Help, usage and
+    any other message argparse would print (stdout carries the results)
+    and exit with, e.g. for --help, fail the job with that message.
+    """
+
+    def error(self, message):
+        raise JobError(message)
+
+    def print_help(self, file=None):
+        raise JobError(self.format_help())
+
+    def print_usage(self, file=None):
+        raise JobError(self.format_usage())
+
+    def _print_message(self, message, file=None):
+        if message:
+            raise JobError(message)
+
+    def exit(self, status=0, message=None):
+        raise JobError(message or f"argument parsing exited with status {status}")
+
+
+class MappingCache:
+    """
+    Compiled mappings, keyed by mapping file path, namespace, prefix and
+    term cache size; their term caches stay warm from job to job. An entry
+    is compiled again once the file's mtime or size changes, or that of one
+    of its lookup tables.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, mapping_path, namespace, prefix, term_cache=4096):
+        """Return (compiled mapping, whether it came from the cache)."""
+        # Imported here, so `serve --help` stays fast
+        from .mapping import load_mapping
+        from .plan import compile_mapping
+
+        stat = os.stat(mapping_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        key = (os.path.abspath(mapping_path), namespace, prefix, term_cache)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version:
+            compiled = entry[1]
+            if compiled.lookups is None or not compiled.lookups.changed():
+                return compiled, True
+        compiled = compile_mapping(load_mapping(mapping_path), namespace, prefix, term_cache)
+        self.entries[key] = (version, compiled)
+        return compiled, False
+
+
+def parse_job(text):
+    """Parse a job from its JSON text."""
+    try:
+        job = json.loads(text)
+    except ValueError as e:
+        raise JobError(f"Job is not valid JSON: {e}")
+    if isinstance(job, list):
+        job = {"args": job}
+    if not isinstance(job, dict) or "args" not in job:
+        raise JobError("Job must be a JSON object with 'args'")
+    return job
+
+
+def job_args(job):
+    args = job["args"]
+    if isinstance(args, str):
+        args = shlex.split(args)
+    if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+        raise JobError("'args' must be a list of strings or a command line")
+    return args
+
+
+def execute(text, mappings, default_id=None):
+    """Run the job in text against the warm state; return its result."""
+    started = (time.perf_counter(), time.process_time())
+    result = {"id": default_id}
+    try:
+        job = parse_job(text)
+        result["id"] = job.get("id", default_id)
+        cli_args = parse_args(job_args(job), JobArgumentParser)
+        logger.info(f"Job {result['id']}: {', '.join(cli_args.mapping)} on {cli_args.data}")
+        result.update(run_job(cli_args, mappings))
+        result["status"] = "ok"
+    except Exception as e:
+        logger.error(f"Job {result['id']} failed: {e}")
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["wall_s"] = time.perf_counter() - started[0]
+    result["cpu_s"] = time.process_time() - started[1]
+    logger.info(f"Job {result['id']} {result['status']} in {result['wall_s']:.3f}s")
+    return result
+
+
+# ----------------------------------------------------------------
+# Job sources
+# ----------------------------------------------------------------
+
+def serve_stdin(mappings):
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        result = execute(line, mappings)
+        sys.stdout.write(json.dumps(result) + "\n")
+        sys.stdout.flush()
+
+
+def serve_socket(socket_path, mappings):
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                result = execute(line.decode("utf-8"), mappings)
+                self.wfile.write((json.dumps(result) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+    remove_stale_socket(socket_path)
+    with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+        logger.info(f"Listening on: {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove a socket file left behind by a server that did not shut down
+    cleanly. Anything else at socket_path, a file that is not a socket or
+    the socket of a server still listening, is left alone.
+    """
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        msg = f"Not a socket, refusing to replace it: {socket_path}"
+        logger.error(msg)
+        raise Exception(msg)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except ConnectionRefusedError:
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    msg = f"Another server is listening on: {socket_path}"
+    logger.error(msg)
+    raise Exception(msg)
+
+
+def serve_directory(watch_dir, mappings, poll=1.0, once=False):
+    """
+    Run the *.json job files that appear in watch_dir, in name order.
+    Job files should be written elsewhere (or under a name not ending in
+    .json) and renamed into place, so a half-written job is never read.
+    """
+    done_dir = os.path.join(watch_dir, "done")
+    failed_dir = os.path.join(watch_dir, "failed")
+    os.makedirs(done_dir, exist_ok=True)
+    os.makedirs(failed_dir, exist_ok=True)
+    logger.info(f"Watching: {watch_dir}")
+    while True:
+        names = sorted(name for name in os.listdir(watch_dir)
+                       if name.endswith(".json") and not name.startswith("."))
+        if not names:
+            if once:
+                return
+            time.sleep(poll)
+            continue
+        for name in names:
+            job_path = os.path.join(watch_dir, name)
+            with open(job_path, "r") as stream:
+                text = stream.read()
+            stem = name[:-len(".json")]
+            result = execute(text, mappings, default_id=stem)
+            target_dir = done_dir if result["status"] == "ok" else failed_dir
+            with open(os.path.join(target_dir, f"{stem}.result.json.part"), "w") as stream:
+                json.dump(result, stream, indent=1)
+            os.replace(os.path.join(target_dir, f"{stem}.result.json.part"),
+                       os.path.join(target_dir, f"{stem}.result.json"))
+            os.replace(job_path, os.path.join(target_dir, name))
+
+
+def build_serve_parser():
+    parser = argparse.ArgumentParser(
+        prog="kastle-foundry.py serve",
+        description="Run Foundry jobs from stdin, a Unix socket or a watched directory, "
+                    "in one process that keeps compiled mappings cached."
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        "--watch",
+        help="Directory to watch for *.json job files"
+    )
+    source.add_argument(
+        "--socket",
+        help="Path of a Unix socket to accept jobs on"
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        default=1.0,
+        help="Seconds between scans of the --watch directory (default: 1)"
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="With --watch, exit once the directory has no jobs left instead of waiting for more"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="Enable verbose logging (DEBUG level)"
+    )
+    parser.add_argument(
+        "--log-file",
+        help="Log file name (if omitted, logs go to stderr)"
+    )
+    return parser
+
+
+def main(argv=None):
+    serve_args = build_serve_parser().parse_args(argv)
+    configure_logging(serve_args)
+
+    # Import everything a job needs now, rather than in the first job
+    import yaml
+    from . import dedup, metrics, output, run
+
+    mappings = MappingCache()
+    try:
+        if serve_args.watch:
+            serve_directory(serve_args.watch, mappings, serve_args.poll, serve_args.once)
+        elif serve_args.socket:
+            serve_socket(serve_args.socket, mappings)
+        else:
+            serve_stdin(mappings)
+    except KeyboardInterrupt:
+        logger.info("Stopped.")
@@ -0,0 +1,69 @@
+"""Namespaces and prefixed-name resolution."""
+import logging
+
+from rdflib import OWL, RDF, RDFS, XSD, TIME
+from rdflib import Graph, Namespace
+
+logger = logging.getLogger(__name__)
+
+# rdf:type shortcut
+a = RDF["type"]
+
+
+class Prefixes(dict):
+    """
+    The prefixes a mapping can use, mapped to their Namespace. <prefix>-r and
+    <prefix>-ont are built from the run's namespace; names without a prefix
+    resolve against <prefix>-r.
+    """
+
+    def __init__(self, namespace, prefix="ex"):
+        super().__init__()
+        self.namespace = namespace
+        self.prefix = prefix
+        self.default = f"{prefix}-r"
+        self.update({
+            f"{prefix}-r": Namespace(f"{namespace}lod/resource/"),
+            f"{prefix}-ont": Namespace(f"{namespace}lod/ontology/"),
+            "geo": Namespace("http://www.opengis.net/ont/geosparql#"),
+            "geof": Namespace("http://www.opengis.net/def/function/geosparql/"),
+            "sf": Namespace("http://www.opengis.net/ont/sf#"),
+            "wd": Namespace("http://www.wikidata.org/entity/"),
+            "wdt": Namespace("http://www.wikidata.org/prop/direct/"),
+            "rdf": RDF,
+            "rdfs": RDFS,
+            "xsd": XSD,
+            "owl": OWL,
+            "time": TIME,
+            "dbo": Namespace("http://dbpedia.org/ontology/"),
+            "ssn": Namespace("http://www.w3.org/ns/ssn/"),
+            "sosa": Namespace("http://www.w3.org/ns/sosa/"),
+            "cdt": Namespace("http://w3id.org/lindt/custom_datatypes#"),
+            "ex": Namespace("https://example.com/"),
+            "dcterms": Namespace("http://purl.org/dc/terms/"),
+        })
+
+
+# Initialization shortcut
+def init_kg(prefixes):
+    kg = Graph()
+    for prefix in prefixes:
+        kg.bind(prefix, prefixes[prefix])
+    return kg
+
+
+def create_uri_from_string(s, prefixes):
+    tokens = s.split(":")
+    if len(tokens) == 1:  # use default namespace
+        prefix, classname = prefixes.default, tokens[0]
+    elif len(tokens) == 2:
+        prefix, classname = tokens
+    else:
+        msg = f"Malformed type found: {s}"
+        logger.error(msg)
+        raise Exception(msg)
+    if prefix not in prefixes:
+        logger.error(f"Unknown prefix '{prefix}' in '{s}'")
+        raise Exception(f"Unknown prefix '{prefix}' in '{s}'")
+
+    return prefixes[prefix][classname]
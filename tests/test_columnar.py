@@ -0,0 +1,88 @@
+"""CSV batches: pyarrow, when installed, must read every file as the csv module does."""
+import csv
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from kastle_foundry import columnar
+
+FILES = {
+    # A short row is padded with None, a long one truncated
+    "ragged.csv": "a,b,c\n1,2,3\n4,5\n6,7,8,9\n10,11,12\n",
+    # Later duplicates of a column name win
+    "duplicate.csv": "a,b,a\n1,2,3\n4,5,6\n",
+    # Blank lines are not rows; a quoted newline does not end one
+    "lines.csv": 'a,b,c\n1,2,3\n\n"4\n4",5,6\n\n7,8,9\n10,11,12\n',
+}
+
+
+def many_blocks(short_row=None):
+    """Blank lines and quoted newlines in a file that pyarrow reads in several blocks."""
+    lines = ["a,b,c"]
+    for i in range(100000):
+        if i % 97 == 0:
+            lines.append("")
+        if i == short_row:
+            lines.append(f"{i},short")
+        elif i % 89 == 0:
+            lines.append(f'{i},"b\n{i}",c{i}')
+        else:
+            lines.append(f"{i},b{i},c{i}")
+    return "\n".join(lines) + "\n"
+
+
+def read_columns(path, start, batch_size=2):
+    columns = {"a": [], "b": [], "c": []}
+    for batch in columnar.iter_csv_batches(path, list(columns), start, batch_size):
+        for name, values in columns.items():
+            values.extend(batch.columns.get(name, [None] * len(batch)))
+    return columns
+
+
+def dict_reader_columns(path, start):
+    with open(path, newline="", encoding="utf-8-sig") as stream:
+        rows = list(csv.DictReader(stream))[start:]
+    return {name: [row.get(name) for row in rows] for name in ("a", "b", "c")}
+
+
+class CsvBatchesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        for name, text in FILES.items():
+            with open(os.path.join(cls.tmp.name, name), "w") as stream:
+                stream.write(text)
+        # The second with a short row in a later block
+        for name, short_row in (("many-blocks.csv", None), ("many-blocks-ragged.csv", 90000)):
+            with open(os.path.join(cls.tmp.name, name), "w") as stream:
+                stream.write(many_blocks(short_row))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def check(self, read):
+        for name in FILES:
+            path = os.path.join(self.tmp.name, name)
+            for start in range(4):
+                with self.subTest(file=name, start=start):
+                    self.assertEqual(read(path, start), dict_reader_columns(path, start))
+        for name in ("many-blocks.csv", "many-blocks-ragged.csv"):
+            path = os.path.join(self.tmp.name, name)
+            for start in (0, 1, 60000, 90000, 99990):
+                with self.subTest(file=name, start=start):
+                    self.assertEqual(read(path, start, 1000), dict_reader_columns(path, start))
+
+    def test_csv_module(self):
+        with mock.patch.object(columnar, "pyarrow", None):
+            self.check(read_columns)
+
+    @unittest.skipIf(columnar.pyarrow is None, "pyarrow is not installed")
+    def test_pyarrow(self):
+        self.check(read_columns)
+
+
+if __name__ == "__main__":
+    unittest.main()
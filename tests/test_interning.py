@@ -0,0 +1,111 @@
+"""
+Interned terms: URIs built without URIRef()'s check (trusted_uri()) must be
+URIRef()'s own, and interning must change neither the terms nor the warnings.
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from rdflib import URIRef
+
+from kastle_foundry import interning
+from kastle_foundry.interning import trusted_uri, uri_maker
+from kastle_foundry.plan import compile_mapping
+
+NAMESPACE = "http://example.org/"
+
+CLEAN_URIS = [
+    "http://example.org/quake.us7000abcd",
+    "http://example.org/quake.a%20b.c%2Fd",
+    "https://example.org/path?q=1&r=2#frag",
+    "urn:uuid:6e8bc430-9c3a-11d9-9669-0800200c9a66",
+    "http://example.org/café/漢",
+    "",
+]
+
+MAPPING = {
+    "root": {
+        "type": "ex-ont:Quake",
+        "uri": "ex-r:quake",
+        "varids": ["id"],
+        "connections": [
+            # A clean pattern, interned
+            {"p": "ex-ont:network", "o": {"type": "ex-ont:Network", "uri": "ex-r:net", "varids": ["net"]}},
+            # Patterns URIRef() warns about, one shared by two nodes
+            {"p": "ex-ont:station", "o": {"type": "ex-ont:Station", "uri": "ex-r:station", "varids": ["net"],
+                                          "appellation": "a b"}},
+            {"p": "ex-ont:region", "o": {"type": "ex-ont:Region", "uri": "ex-r:region", "varids": ["region"],
+                                         "appellation": "|x"}},
+            {"p": "ex-ont:area", "o": {"type": "ex-ont:Region", "uri": "ex-r:region", "varids": ["region"],
+                                       "appellation": "|x"}},
+        ],
+    },
+}
+
+
+class TrustedUriTest(unittest.TestCase):
+
+    def test_same_as_uriref(self):
+        for uri in CLEAN_URIS:
+            with self.subTest(uri=uri):
+                trusted, checked = trusted_uri(uri), URIRef(uri)
+                self.assertIs(type(trusted), URIRef)
+                self.assertEqual(trusted, checked)
+                self.assertEqual(hash(trusted), hash(checked))
+                self.assertEqual(trusted.n3(), checked.n3())
+
+    def test_uri_maker(self):
+        self.assertIs(uri_maker("http://example.org/quake.", ""), trusted_uri)
+        self.assertIs(uri_maker("http://example.org/quake.", "a b"), URIRef)
+        self.assertIs(uri_maker("http://example.org/<quake>.", ""), URIRef)
+
+    def test_without_rdflib_check(self):
+        # The installed rdflib still has the private check this relies on
+        self.assertIsNotNone(interning.rdflib_uri_check())
+        with mock.patch.object(interning, "_is_valid_uri", None):
+            self.assertIs(uri_maker("http://example.org/quake.", ""), URIRef)
+
+
+class InterningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.tmp.name, "quakes.csv")
+        with open(self.data_path, "w") as stream:
+            stream.write("id,net,region\n")
+            for i in range(50):
+                stream.write(f"q{i},{['us', 'nc', 'ci'][i % 3]},r {i % 4}\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def transform(self, engine, term_cache):
+        compiled = compile_mapping(MAPPING, NAMESPACE, "ex", term_cache)
+        with self.assertLogs("rdflib.term", "WARNING") as logs:
+            rows = [list(triples) for batch in compiled.read_batches(self.data_path, engine=engine)
+                    for triples in compiled.transform_batch(batch)]
+        hits = sum(terms.counts()[0] for terms in compiled.term_caches)
+        return rows, logs.output, hits
+
+    def test_same_terms_and_warnings(self):
+        for engine in ("row", "columnar"):
+            with self.subTest(engine=engine):
+                rows, warnings, hits = self.transform(engine, 4096)
+                plain_rows, plain_warnings, plain_hits = self.transform(engine, 0)
+                self.assertGreater(hits, 0)
+                self.assertEqual(plain_hits, 0)
+                self.assertEqual(rows, plain_rows)
+                self.assertEqual([[hash(term) for triple in row for term in triple] for row in rows],
+                                 [[hash(term) for triple in row for term in triple] for row in plain_rows])
+                for row in rows:
+                    for s, p, o in row:
+                        self.assertEqual(s, URIRef(str(s)))
+                # One warning per URI built from a pattern that is not clean, with or without interning:
+                # per row, one station URI and one region URI (shared by two nodes)
+                self.assertEqual(warnings, plain_warnings)
+                self.assertEqual(len(warnings), 2 * 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+LiteralCodec builds Literals without rdflib's conversion (make_literal()
+sets rdflib's private attributes): its terms must stay those of Literal().
+"""
+import logging
+import unittest
+import warnings
+
+from rdflib import XSD, Literal
+
+from kastle_foundry.literals import CODECS, LiteralCodec
+
+VALUES = {
+    XSD.double: ["1", "1.0", "-0", "0.1", "1e10", "1.5E-3", "+1", ".5", "5.", "1e400", "INF", "-INF", "NaN",
+                 "inf", "1_000", " 1", "0x10", "abc"],
+    XSD.integer: ["0", "-0", "+5", "007", "42", "99999999999999999999", "1_000", " 3", "3 ", "1.0", "1e3",
+                  "12a", "٣"],
+    XSD.decimal: ["1", "1.50", "-0.0", "+.5", "5.", "0.000001", "1e3", "1E-7", "NaN", "Infinity", "1_0",
+                  " 2", "abc"],
+    XSD.boolean: ["true", "false", "1", "0", "True", "FALSE", "yes", " true", "2"],
+    XSD.dateTime: ["2020-01-01T00:00:00", "2020-01-01T00:00:00Z", "2020-01-01T00:00:00+02:00",
+                   "2020-01-01T00:00:00.123456", "2020-01-01T00:00:00.1", "2020-01-01T00:00", "2020-01-01",
+                   "2020-01-01 00:00:00", "20200101T000000", "2020-13-01T00:00:00", "2020-01-01T24:00:00",
+                   "-2020-01-01T00:00:00", "garbage"],
+    XSD.date: ["2020-01-01", "2020-02-29", "2020-1-1", "2020-01-01Z", "2020-01-01+02:00", "-2020-01-01",
+               "2021-02-29", "20200101", "2020-W01-1", "garbage"],
+}
+
+
+def same_value(a, b):
+    # NaN (float or Decimal) is not equal to itself
+    return type(a) is type(b) and (a == b or (a != a and b != b))
+
+
+class MakeLiteralTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # rdflib logs a warning with a traceback for every value it cannot convert
+        logging.disable(logging.WARNING)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def setUp(self):
+        # ... and warns on reading an odd boolean or writing an ill-typed number
+        catcher = warnings.catch_warnings()
+        catcher.__enter__()
+        self.addCleanup(catcher.__exit__, None, None, None)
+        warnings.simplefilter("ignore", UserWarning)
+
+    def check(self, literal, lexical, datatype):
+        expected = Literal(lexical, datatype=datatype)
+        self.assertEqual(literal, expected)
+        # eq() compares values, so, as between two rdflib Literals, it is False for NaN
+        self.assertEqual(literal.eq(expected), Literal(lexical, datatype=datatype).eq(expected))
+        self.assertEqual(hash(literal), hash(expected))
+        self.assertEqual(str(literal), str(expected))
+        self.assertEqual(literal.n3(), expected.n3())
+        self.assertEqual(literal.datatype, expected.datatype)
+        self.assertEqual(literal.language, expected.language)
+        self.assertEqual(literal.ill_typed, expected.ill_typed)
+        self.assertTrue(same_value(literal.value, expected.value), (literal.value, expected.value))
+
+    def test_every_codec_has_values(self):
+        self.assertEqual(set(VALUES), set(CODECS))
+
+    def test_build(self):
+        for datatype, values in VALUES.items():
+            codec = LiteralCodec(datatype)
+            for lexical in values:
+                with self.subTest(datatype=datatype, lexical=lexical):
+                    self.check(codec.build(lexical), lexical, datatype)
+
+    def test_encode_column(self):
+        for datatype, values in VALUES.items():
+            codec = LiteralCodec(datatype)
+            # Without the term cache, encode_column() builds the Literals itself
+            codec.terms.drop()
+            for lexical, literal in zip(values, codec.encode_column(values)):
+                with self.subTest(datatype=datatype, lexical=lexical):
+                    self.check(literal, lexical, datatype)
+
+
+if __name__ == "__main__":
+    unittest.main()
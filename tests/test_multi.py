@@ -0,0 +1,63 @@
+"""Several mappings in one pass: each mapping must see the rows it would see alone."""
+import os
+import tempfile
+import unittest
+
+from kastle_foundry.multi import MultiMapping
+from kastle_foundry.plan import compile_mapping
+
+NAMESPACE = "http://example.org/"
+
+
+def label_mapping(predicate):
+    return {
+        "root": {
+            "type": "ex-ont:Quake",
+            "uri": "ex-r:quake",
+            "varids": ["id"],
+            "connections": [
+                {"p": predicate, "o": {"datatype": "xsd:string", "val_source": "agency.name"}},
+            ],
+        },
+    }
+
+
+class LookupColumnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.tmp.name, "quakes.csv")
+        with open(self.data_path, "w") as stream:
+            # A column named like the lookup column of the first mapping
+            stream.write("id,net,agency.name\n1,us,from the file\n2,nc,also from the file\n")
+        networks_path = os.path.join(self.tmp.name, "networks.csv")
+        with open(networks_path, "w") as stream:
+            stream.write("code,name\nus,USGS\nnc,NCSN\n")
+        self.joined = label_mapping("ex-ont:agency")
+        self.joined["lookups"] = {"agency": {"file": networks_path, "key": "code", "match": "net"}}
+        self.plain = label_mapping("ex-ont:label")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def transform(self, compiled, engine):
+        return [list(triples) for batch in compiled.read_batches(self.data_path, engine=engine)
+                for triples in compiled.transform_batch(batch)]
+
+    def test_lookup_does_not_leak_into_next_mapping(self):
+        for engine in ("row", "columnar"):
+            with self.subTest(engine=engine):
+                joined = compile_mapping(self.joined, NAMESPACE, "ex")
+                plain = compile_mapping(self.plain, NAMESPACE, "ex")
+                multi = MultiMapping([joined, plain], ["joined", "plain"])
+                rows = self.transform(multi, engine)
+                alone = [self.transform(compile_mapping(mapping, NAMESPACE, "ex"), engine)
+                         for mapping in (self.joined, self.plain)]
+                for i, triples in enumerate(alone):
+                    self.assertEqual([list(row[i]) for row in rows], triples)
+                labels = sorted(str(o) for row in rows for s, p, o in row[1] if p.endswith("label"))
+                self.assertEqual(labels, ["also from the file", "from the file"])
+
+
+if __name__ == "__main__":
+    unittest.main()
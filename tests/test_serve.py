@@ -0,0 +1,71 @@
+"""Serve mode: a job's arguments must not take the server down."""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FOUNDRY = os.path.join(REPO_DIR, "kastle-foundry.py")
+EXAMPLES = os.path.join(REPO_DIR, "example_inputs")
+
+
+class ServeStdinTest(unittest.TestCase):
+
+    def test_help_job_fails_alone(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            jobs = [
+                {"id": "help", "args": ["--help"]},
+                {"id": "run", "args": [
+                    "-m", os.path.join(EXAMPLES, "earthquake-mapping.yaml"),
+                    "-d", os.path.join(EXAMPLES, "earthquake_example_data.csv"),
+                    "-o", output_dir, "--namespace", "http://stko-kwg.geog.ucsb.edu/", "--prefix", "kwg",
+                    "--format", "nt"]},
+            ]
+            served = subprocess.run([sys.executable, FOUNDRY, "serve"], cwd=REPO_DIR,
+                                    input="".join(json.dumps(job) + "\n" for job in jobs),
+                                    capture_output=True, text=True, timeout=120)
+            self.assertEqual(served.returncode, 0, served.stderr)
+            # stdout holds one result per job, and nothing else
+            results = [json.loads(line) for line in served.stdout.splitlines()]
+            self.assertEqual([result["id"] for result in results], ["help", "run"])
+            self.assertEqual(results[0]["status"], "error")
+            self.assertIn("usage:", results[0]["error"])
+            self.assertEqual(results[1]["status"], "ok", results[1].get("error"))
+            self.assertTrue(os.path.exists(os.path.join(output_dir, "output-earthquake_example_data.nt")))
+
+
+
+class ServeSocketTest(unittest.TestCase):
+
+    def test_regular_file_left_alone(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "jobs.txt")
+            with open(path, "w") as stream:
+                stream.write("not a socket\n")
+            served = subprocess.run([sys.executable, FOUNDRY, "serve", "--socket", path], cwd=REPO_DIR,
+                                    capture_output=True, text=True, timeout=60)
+            self.assertNotEqual(served.returncode, 0)
+            self.assertIn("Not a socket", served.stderr)
+            with open(path) as stream:
+                self.assertEqual(stream.read(), "not a socket\n")
+
+    def test_only_stale_socket_removed(self):
+        from kastle_foundry.serve import remove_stale_socket
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "foundry.sock")
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listening:
+                listening.bind(path)
+                listening.listen()
+                with self.assertRaises(Exception):
+                    remove_stale_socket(path)
+                self.assertTrue(os.path.exists(path))
+            # Closed without unlinking, as by a server that was killed
+            remove_stale_socket(path)
+            self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()